@@ -59,6 +59,7 @@ in
     bats
     just
     nixd
+    python3Packages.websocket-client
   ] ++ trayDevPackages;
 
   scripts.mail-sync-tests.exec = ''
@@ -81,6 +82,9 @@ in
       pytest modules/home/mail/tray-src "$@"
     ''
   ];
+  scripts.weechat-slack-tests.exec = ''
+    pytest modules/home/weechat/test_slack.py "$@"
+  '';
 
   git-hooks = {
     hooks.mail-sync-tests = {
@@ -5,18 +5,22 @@
 
 from __future__ import print_function, unicode_literals
 
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from datetime import date, datetime, timedelta
 from functools import partial, wraps
 from io import StringIO
 from itertools import chain, count, islice
 
+import base64
+import bisect
 import copy
 import errno
+import heapq
 import textwrap
 import time
 import json
 import hashlib
+import marshal
 import os
 import re
 import sys
@@ -25,6 +29,7 @@ import ssl
 import random
 import socket
 import string
+import threading
 
 # Prevent websocket from using numpy (it's an optional dependency). We do this
 # because numpy causes python (and thus weechat) to crash when it's reloaded.
@@ -63,6 +68,16 @@ try:
 except ImportError:
     from urllib import quote, urlencode
 
+try:
+    from http.client import HTTPException, HTTPSConnection
+except ImportError:
+    from httplib import HTTPException, HTTPSConnection
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
 try:
     JSONDecodeError = json.JSONDecodeError
 except AttributeError:
@@ -83,6 +98,68 @@ REPO_URL = "https://github.com/wee-slack/wee-slack"
 
 TYPING_DURATION = 6
 
+# How many members are added to or removed from nicklists per tick, so big
+# channels are filled in over a few ticks instead of blocking weechat
+NICKLIST_BATCH_SIZE = 500
+
+# The minor part of a Slack timestamp has six digits
+SLACK_TS_MINOR_UNITS = 1000000
+
+# The fields of a message's json which are kept when the rest is dropped to
+# save memory (see message_json_budget). These are what's needed to update the
+# message, while the rendered body of the message is kept instead of the rest.
+SLIM_MESSAGE_KEYS = (
+    "ts",
+    "type",
+    "subtype",
+    "user",
+    "text",
+    "bot_id",
+    "username",
+    "service_name",
+    "user_profile",
+    "user_team",
+    "team",
+    "thread_ts",
+    "reply_count",
+    "latest_reply",
+    "reply_broadcast",
+    "subscribed",
+    "last_read",
+    "reactions",
+    "edited",
+)
+
+INTERNED_IDS = {}
+
+# How references to users, channels and subteams in messages are displayed.
+# Cleared on the next lookup after a user, channel or subteam is added or
+# renamed, see invalidate_resolved_refs.
+RESOLVED_REFS = {}
+RESOLVED_REFS_STALE = False
+
+# How date references are displayed, with the day they were resolved on, since
+# they can say today or yesterday. Cleared when it reaches the max size.
+RESOLVED_DATE_REFS = {}
+RESOLVED_DATE_REFS_MAX = 1000
+
+DATE_REF_FORMATS = {
+    "date_num": "%Y-%m-%d",
+    "date": "%B %d, %Y",
+    "date_short": "%b %d, %Y",
+    "date_long": "%A, %B %d, %Y",
+    "time": "%H:%M",
+    "time_secs": "%H:%M:%S",
+}
+
+# How long (ms) to collect unknown user ids before resolving them, how many
+# unknown users it takes before we fetch the whole user list instead of looking
+# them up one by one, and how long (s) to wait for a batch before giving up.
+USER_RESOLVE_DELAY = 250
+USER_RESOLVE_LIST_THRESHOLD = 20
+USER_RESOLVE_TIMEOUT = 60
+USER_RESOLVE_INFO_LIMIT = 100
+
 RECORD_DIR = "/tmp/weeslack-debug"
 
 SLACK_API_TRANSLATOR = {
@@ -135,6 +212,58 @@ SLACK_API_TRANSLATOR = {
     },
 }
 
+# Slack's rate limit tiers as (requests per minute, burst size), see
+# https://api.slack.com/docs/rate-limits
+SLACK_API_RATE_LIMIT_TIERS = {
+    1: (1, 3),
+    2: (20, 5),
+    3: (50, 10),
+    4: (100, 20),
+}
+
+SLACK_API_RATE_LIMIT_DEFAULT_TIER = 3
+
+SLACK_API_METHOD_TIERS = {
+    "conversations.close": 2,
+    "conversations.create": 2,
+    "conversations.history": 3,
+    "conversations.info": 3,
+    "conversations.invite": 3,
+    "conversations.join": 3,
+    "conversations.leave": 3,
+    "conversations.mark": 3,
+    "conversations.members": 4,
+    "conversations.open": 3,
+    "conversations.replies": 3,
+    "conversations.setTopic": 2,
+    "emoji.list": 2,
+    "reactions.add": 3,
+    "reactions.remove": 2,
+    "rtm.connect": 1,
+    "rtm.start": 1,
+    "usergroups.users.list": 2,
+    "users.info": 4,
+    "users.list": 2,
+    "users.profile.set": 3,
+    "users.setPresence": 2,
+}
+
+# Methods without side effects beyond the first call, where identical requests
+# which are in flight at the same time can share one reply.
+SLACK_API_COALESCED_METHODS = {
+    "conversations.info",
+    "conversations.mark",
+    "conversations.members",
+    "emoji.list",
+    "subscriptions.thread.mark",
+    "usergroups.users.list",
+    "users.info",
+    "users.list",
+}
+
+REQUEST_PRIORITY_INTERACTIVE = 0
+REQUEST_PRIORITY_BACKGROUND = 1
+
 CONFIG_PREFIX = "plugins.var.python." + SCRIPT_NAME
 
 ###### Decorators have to be up here
@@ -199,7 +328,9 @@ if hasattr(ssl, "get_default_verify_paths") and callable(ssl.get_default_verify_
         sslopt_ca_certs = {"ca_certs": ssl_defaults.cafile}
 
 EMOJI = {}
-EMOJI_WITH_SKIN_TONES_REVERSE = {}
+EMOJI_CHARS_TRIE = {}
+EMOJI_LOADED = False
+WEECHAT_COLORS = {}
 
 ###### Unicode handling
 
@@ -350,12 +481,46 @@ class ValuesViewReversible(ValuesView, Reversible):
             yield self._mapping[key]
 
 
+class ReadOnlyMapping(Mapping):
+    """
+    A read-only view of a dict, so an index can be handed out without
+    copying it or letting the caller change it.
+    """
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+    def __getitem__(self, key):
+        return self._mapping[key]
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __iter__(self):
+        return iter(self._mapping)
+
+    def __len__(self):
+        return len(self._mapping)
+
+
 ##### Helpers
 
 
+def get_color(color):
+    """
+    Returns the weechat color code for a color name. The codes are cached,
+    since they are looked up for every message which is rendered. The cache
+    is cleared when the settings or the weechat palette change.
+    """
+    code = WEECHAT_COLORS.get(color)
+    if code is None:
+        code = WEECHAT_COLORS[color] = w.color(color)
+    return code
+
+
 def colorize_string(color, string, reset_color="reset"):
     if color:
-        return w.color(color) + string + w.color(reset_color)
+        return get_color(color) + string + get_color(reset_color)
     else:
         return string
 
@@ -407,6 +572,26 @@ def get_thread_color(thread_id):
         return config.color_thread_suffix
 
 
+def insort_unique(sorted_list, item):
+    i = bisect.bisect_left(sorted_list, item)
+    if i == len(sorted_list) or sorted_list[i] != item:
+        sorted_list.insert(i, item)
+
+
+def remove_sorted(sorted_list, item):
+    i = bisect.bisect_left(sorted_list, item)
+    if i < len(sorted_list) and sorted_list[i] == item:
+        del sorted_list[i]
+
+
+def intern_id(identifier):
+    """
+    Returns a shared copy of a Slack id, so the ids of the many messages from
+    the same user or team don't each take up memory.
+    """
+    return INTERNED_IDS.setdefault(identifier, identifier)
+
+
 def sha1_hex(s):
     return str(hashlib.sha1(s.encode("utf-8")).hexdigest())
 
@@ -449,14 +634,36 @@ EMOJI_NAME_REGEX_STRING = ":(?P<emoji_name>[a-z0-9_+-]+):"
 EMOJI_CHAR_OR_NAME_REGEX_STRING = "({}|{})".format(
     EMOJI_CHAR_REGEX_STRING, EMOJI_NAME_REGEX_STRING
 )
+EMOJI_CHAR_REGEX = re.compile(EMOJI_CHAR_REGEX_STRING)
 EMOJI_NAME_REGEX = re.compile(EMOJI_NAME_REGEX_STRING)
 EMOJI_CHAR_OR_NAME_REGEX = re.compile(EMOJI_CHAR_OR_NAME_REGEX_STRING)
+REACTION_INPUT_REGEX = re.compile(
+    r"{}{}\s*$".format(REACTION_PREFIX_REGEX_STRING, EMOJI_CHAR_OR_NAME_REGEX_STRING)
+)
+SUBSTITUTE_INPUT_REGEX = re.compile("{}?s/".format(MESSAGE_ID_REGEX_STRING))
+
+BOLD_REGEX = re.compile(r"(^| )\*([^*\n`]+)\*(?=[^\w]|$)", re.UNICODE)
+ITALIC_REGEX = re.compile(r"(^| )_([^_\n`]+)_(?=[^\w]|$)", re.UNICODE)
+REF_REGEX = re.compile(r"<([^|>]*)(?:\|([^>]*))?>")
+URL_SCHEME_REGEX = re.compile(r"\w+:")
+
+
+def get_emoji():
+    """
+    Returns the emoji table, which is loaded the first time an emoji is
+    rendered or completed rather than when the script is loaded.
+    """
+    global EMOJI, EMOJI_CHARS_TRIE, EMOJI_LOADED
+    if not EMOJI_LOADED:
+        EMOJI, EMOJI_CHARS_TRIE = load_emoji()
+        EMOJI_LOADED = True
+    return EMOJI
 
 
 def regex_match_to_emoji(match, include_name=False):
     emoji = match.group(1)
     full_match = match.group()
-    char = EMOJI.get(emoji, full_match)
+    char = get_emoji().get(emoji, full_match)
     if include_name and char != full_match:
         return "{} ({})".format(char, full_match)
     return char
@@ -464,24 +671,282 @@ def regex_match_to_emoji(match, include_name=False):
 
 def replace_string_with_emoji(text):
     if config.render_emoji_as_string == "both":
+        if ":" not in text:
+            return text
         return EMOJI_NAME_REGEX.sub(
             partial(regex_match_to_emoji, include_name=True),
             text,
         )
     elif config.render_emoji_as_string:
+        return replace_emoji_chars_with_string(text)
+    if ":" not in text:
         return text
     return EMOJI_NAME_REGEX.sub(regex_match_to_emoji, text)
 
 
+def build_emoji_trie(emoji_chars):
+    """
+    Builds a trie from (chars, name) pairs, as nested dicts keyed by each
+    character. The name of an emoji is stored under "" in the node where its
+    characters end.
+    """
+    trie = {}
+    for chars, name in emoji_chars:
+        node = trie
+        for char in chars:
+            node = node.setdefault(char, {})
+        node[""] = name
+    return trie
+
+
+def match_emoji_chars(text, start=0):
+    """
+    Finds the longest emoji starting at start in text. Returns the index
+    after the emoji and its name, or start and None if there is none.
+    """
+    node = EMOJI_CHARS_TRIE
+    end, name = start, None
+    for i in range(start, len(text)):
+        node = node.get(text[i])
+        if node is None:
+            break
+        if "" in node:
+            end, name = i + 1, node[""]
+    return end, name
+
+
+def replace_emoji_chars_with_string(text):
+    get_emoji()
+
+    def replace_chars(match):
+        chars = match.group()
+        result = []
+        i = 0
+        while i < len(chars):
+            end, name = match_emoji_chars(chars, i)
+            if name:
+                result.append(":{}:".format(name))
+                i = end
+            else:
+                result.append(chars[i])
+                i += 1
+        return "".join(result)
+
+    return EMOJI_CHAR_REGEX.sub(replace_chars, text)
+
+
 def replace_emoji_with_string(text):
-    emoji = None
-    key = text
-    while emoji is None and len(key):
-        emoji = EMOJI_WITH_SKIN_TONES_REVERSE.get(key)
-        key = key[:-1]
+    get_emoji()
+    _, emoji = match_emoji_chars(text)
     return emoji or text
 
 
+class SlackWorkerPool(object):
+    """
+    Runs jobs in a small pool of worker threads. Results are queued and the
+    main loop is woken up through a pipe watched with hook_fd, so the
+    callbacks for the results, and with them all weechat API calls, run on
+    the main thread. A job is a (function, args) tuple, and its callback is
+    called with the result and the formatted exception, if any. Subclasses
+    can override run, which must not call the weechat API.
+    """
+
+    def __init__(self, name, size):
+        self.jobs = Queue()
+        self.results = deque()
+        self.read_fd, self.write_fd = os.pipe()
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.hook = w.hook_fd(self.read_fd, 1, 0, 0, "receive_worker_callback", name)
+        self.threads = []
+        for _ in range(max(1, size)):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job, callback):
+        self.jobs.put((job, callback))
+
+    def run(self, job):
+        function, args = job
+        try:
+            return (function(*args), None)
+        except Exception:
+            return (None, format_exc_tb())
+
+    def stop_worker(self):
+        pass
+
+    def results_ready(self):
+        try:
+            os.read(self.read_fd, 4096)
+        except OSError:
+            pass
+        while self.results:
+            yield self.results.popleft()
+
+    def close(self):
+        w.unhook(self.hook)
+        for _ in self.threads:
+            self.jobs.put(None)
+        with self.write_lock:
+            self.closed = True
+            os.close(self.write_fd)
+        os.close(self.read_fd)
+
+    def worker(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                break
+            job, callback = item
+            self.results.append((callback, self.run(job)))
+            with self.write_lock:
+                if not self.closed:
+                    os.write(self.write_fd, b"x")
+        self.stop_worker()
+
+
+class SlackConnectionPool(SlackWorkerPool):
+    """
+    Sends Slack API requests over a small pool of persistent HTTPS
+    connections, instead of starting a curl process with a new TLS handshake
+    for every request. Each worker thread keeps its own connection alive.
+    The callback gets the same arguments as receive_httprequest_callback.
+    """
+
+    def __init__(self, name, size, timeout):
+        self.timeout = timeout
+        self.proxy = ProxyWrapper()
+        self.ssl_context = ssl.create_default_context(
+            cafile=sslopt_ca_certs.get("ca_certs")
+        )
+        self.local = threading.local()
+        super(SlackConnectionPool, self).__init__(name, size)
+
+    def submit_request(self, context, request, callback):
+        path = request.url.split(request.domain, 1)[1]
+        headers = {"User-Agent": request.params["useragent"]}
+        self.submit((context, request.domain, path, headers), callback)
+
+    def run(self, job):
+        context, host, path, headers = job
+        try:
+            return (context, "", 0, self.fetch(host, path, headers), "")
+        except Exception as e:
+            return (context, "", 1, "", "{}".format(e))
+
+    def stop_worker(self):
+        for connection in getattr(self.local, "connections", {}).values():
+            connection.close()
+
+    def connect(self, host):
+        if self.proxy.has_proxy:
+            connection = HTTPSConnection(
+                self.proxy.proxy_address,
+                self.proxy.proxy_port or None,
+                timeout=self.timeout,
+                context=self.ssl_context,
+            )
+            headers = {}
+            if self.proxy.proxy_user and self.proxy.proxy_password:
+                credentials = "{}:{}".format(
+                    self.proxy.proxy_user, self.proxy.proxy_password
+                )
+                headers["Proxy-Authorization"] = "Basic {}".format(
+                    base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+                )
+            connection.set_tunnel(host, headers=headers)
+        else:
+            connection = HTTPSConnection(
+                host, timeout=self.timeout, context=self.ssl_context
+            )
+        return connection
+
+    def fetch(self, host, path, headers):
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        connections = self.local.connections
+        while True:
+            connection = connections.pop(host, None)
+            reused = connection is not None
+            if not reused:
+                connection = self.connect(host)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (HTTPException, socket.error):
+                connection.close()
+                # The server may have closed a kept alive connection, so
+                # retry once on a new one before giving up
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                connections[host] = connection
+            response_headers = "".join(
+                "{}: {}\r\n".format(name, value)
+                for name, value in response.getheaders()
+            )
+            return "HTTP/1.1 {} {}\r\n{}\r\n{}".format(
+                response.status,
+                response.reason,
+                response_headers,
+                body.decode("utf-8"),
+            )
+
+
+class HttpReplyBuffer(object):
+    """
+    Collects the fragments of a reply from weechat's url transfer, so it only
+    has to be joined and decoded once, when the transfer is done.
+    """
+
+    def __init__(self):
+        self.buffer = StringIO()
+        self.fragments = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, out):
+        self.buffer.write(out)
+        self.fragments += 1
+        self.size += len(out)
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+def split_http_response(response):
+    """
+    Splits the output of a url: request made with the header option into the
+    status code, the headers (with lower case names) and the body. If the
+    request went through a proxy there may be more than one header block, in
+    which case the last one is used.
+    """
+    status = None
+    headers = {}
+    while response.startswith("HTTP/"):
+        header_block, separator, body = response.partition("\r\n\r\n")
+        if not separator:
+            return None, {}, ""
+        lines = header_block.split("\r\n")
+        status_parts = lines[0].split(None, 2)
+        status = int(status_parts[1]) if len(status_parts) > 1 else None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        response = body
+    return status, headers, response
+
+
 ###### New central Event router
 
 
@@ -496,15 +961,22 @@ class EventRouter(object):
         It has a recorder that, when enabled, logs most events
         to the location specified in RECORD_DIR.
         """
-        self.queue = []
-        self.slow_queue = []
-        self.slow_queue_timer = 0
+        self.queue = deque()
+        self.request_scheduler = SlackRequestScheduler()
+        self.inflight_requests = {}
+        self.coalesced_count = 0
+        self.connection_pool = None
+        self.background_worker = None
         self.teams = {}
         self.subteams = {}
         self.context = {}
         self.weechat_controller = WeechatController(self)
         self.previous_buffer = ""
         self.reply_buffer = {}
+        self.replies_received = 0
+        self.reply_size_total = 0
+        self.reply_fragments_total = 0
+        self.largest_reply = None
         self.cmds = get_functions_with_prefix("command_")
         self.proc = get_functions_with_prefix("process_")
         self.handlers = get_functions_with_prefix("handle_")
@@ -514,6 +986,12 @@ class EventRouter(object):
         self.recording_path = "/tmp"
         self.handle_next_hook = None
         self.handle_next_hook_interval = -1
+        self.events_processed = 0
+        self.events_processed_last_tick = 0
+        self.queue_depth_max = 0
+        self.drain_rate = 0.0
+        self.drain_rate_time = time.time()
+        self.drain_rate_count = 0
 
     def record(self):
         """
@@ -598,6 +1076,7 @@ class EventRouter(object):
         """
         if isinstance(team, SlackTeam):
             self.teams[team.get_team_hash()] = team
+            invalidate_resolved_refs()
         else:
             raise InvalidType(type(team))
 
@@ -654,17 +1133,112 @@ class EventRouter(object):
             message_json["wee_slack_metadata_team"] = team
             self.receive(message_json)
 
+    def get_connection_pool(self):
+        if not self.connection_pool:
+            self.connection_pool = SlackConnectionPool(
+                "connection_pool",
+                config.http_connection_pool_size,
+                config.slack_timeout / 1000.0,
+            )
+        return self.connection_pool
+
+    def get_background_worker(self):
+        if not self.background_worker:
+            self.background_worker = SlackWorkerPool("background_worker", 1)
+        return self.background_worker
+
+    def close_workers(self):
+        if self.connection_pool:
+            self.connection_pool.close()
+            self.connection_pool = None
+        if self.background_worker:
+            self.background_worker.close()
+            self.background_worker = None
+
+    @utf8_decode
+    def receive_worker_callback(self, pool_name, fd):
+        """
+        Called by weechat when a thread of one of the worker pools has
+        finished a job. Runs the callbacks for the finished jobs on the main
+        thread.
+        """
+        pool = getattr(self, pool_name)
+        if pool:
+            for callback, result in pool.results_ready():
+                callback(*result)
+        return w.WEECHAT_RC_OK
+
+    def receive_reply(self, data, request_metadata, j):
+        try:
+            j["wee_slack_process_method"] = request_metadata.request_normalized
+            if self.recording:
+                self.record_event(
+                    j, request_metadata.team, "wee_slack_process_method", "http"
+                )
+            waiters = self.finish_request(request_metadata)
+            replies = [(j, request_metadata)]
+            replies.extend((copy.deepcopy(j), waiter) for waiter in waiters)
+            for reply, request in replies:
+                reply["wee_slack_request_metadata"] = request
+            for reply, _ in replies:
+                self.receive(reply)
+            self.delete_context(data)
+        except:
+            dbg("HTTP REQUEST CALLBACK FAILED", True)
+            self.delete_context(data)
+            self.fail_request(request_metadata)
+
+    def receive_decoded_reply(self, data, request_metadata, result, error):
+        """
+        Receives a reply which was decoded in the background worker. The
+        result is the decoded json and the team model built from it.
+        """
+        if error:
+            dbg(
+                "Decoding reply to {} failed:\n{}".format(
+                    request_metadata.request, error
+                ),
+                level=5,
+            )
+            self.delete_context(data)
+            self.receive(request_metadata)
+            return
+        j, team_model = result
+        request_metadata.metadata["team_model"] = team_model
+        self.receive_reply(data, request_metadata, j)
+
+    def record_reply(self, request, reply_buffer):
+        dbg(
+            "Reply to {} took {} fragments, {} chars".format(
+                request.request, reply_buffer.fragments, reply_buffer.size
+            ),
+            level=1,
+        )
+        self.replies_received += 1
+        self.reply_size_total += reply_buffer.size
+        self.reply_fragments_total += reply_buffer.fragments
+        if not self.largest_reply or reply_buffer.size > self.largest_reply[1]:
+            self.largest_reply = (
+                request.request,
+                reply_buffer.size,
+                reply_buffer.fragments,
+            )
+
     @utf8_decode
     def receive_httprequest_callback(self, data, command, return_code, out, err):
         """
         complete
         Receives the result of an http request we previously handed
         off to weechat (weechat bundles libcurl). Weechat can fragment
-        replies, so it buffers them until the reply is complete.
+        replies, so it buffers the fragments (return code -1) and
+        decodes the reply once the transfer is done (return code 0).
         It is then populated with metadata here so we can identify
         where the request originated and route properly.
         """
         request_metadata = self.retrieve_context(data)
+        if request_metadata is None:
+            dbg("Received callback for unknown context {}".format(data), level=4)
+            return w.WEECHAT_RC_OK
         dbg(
             "RECEIVED CALLBACK with request of {} id of {} and  code {} of length {}".format(
                 request_metadata.request,
@@ -673,40 +1247,63 @@ class EventRouter(object):
                 len(out),
             )
         )
+        if return_code in (0, -1) and out:
+            if request_metadata.response_id not in self.reply_buffer:
+                self.reply_buffer[request_metadata.response_id] = HttpReplyBuffer()
+            self.reply_buffer[request_metadata.response_id].write(out)
+
         if return_code == 0:
-            if len(out) > 0:
-                if request_metadata.response_id not in self.reply_buffer:
-                    self.reply_buffer[request_metadata.response_id] = StringIO()
-                self.reply_buffer[request_metadata.response_id].write(out)
-                try:
-                    j = json.loads(
-                        self.reply_buffer[request_metadata.response_id].getvalue()
+            reply_buffer = self.reply_buffer.get(request_metadata.response_id)
+            if reply_buffer:
+                status, headers, body = split_http_response(reply_buffer.getvalue())
+                if status == 429:
+                    self.reply_buffer.pop(request_metadata.response_id)
+                    self.delete_context(data)
+                    retry_after = headers.get("retry-after", "")
+                    retry_after = int(retry_after) if retry_after.isdigit() else 60
+                    dbg(
+                        "Rate limited on {}, retrying after {}s".format(
+                            request_metadata.request, retry_after
+                        ),
+                        level=4,
                     )
-                except:
-                    pass
-                    # dbg("Incomplete json, awaiting more", True)
+                    self.request_scheduler.rate_limited(request_metadata, retry_after)
+                    return w.WEECHAT_RC_OK
+                if request_metadata.request == "rtm.start":
+                    # The rtm.start reply can be many megabytes for large
+                    # teams, so decode it and build the team model in a
+                    # worker thread to keep the UI responsive
+                    self.reply_buffer.pop(request_metadata.response_id)
+                    self.record_reply(request_metadata, reply_buffer)
+                    self.get_background_worker().submit(
+                        (decode_rtm_start, (body,)),
+                        partial(self.receive_decoded_reply, data, request_metadata),
+                    )
+                    return w.WEECHAT_RC_OK
                 try:
-                    j["wee_slack_process_method"] = request_metadata.request_normalized
-                    if self.recording:
-                        self.record_event(
-                            j, request_metadata.team, "wee_slack_process_method", "http"
-                        )
-                    j["wee_slack_request_metadata"] = request_metadata
+                    j = json.loads(body)
+                except JSONDecodeError:
+                    # The transfer is done, so no more data will come
+                    dbg(
+                        "Invalid json in reply to {}".format(request_metadata.request),
+                        level=4,
+                    )
                     self.reply_buffer.pop(request_metadata.response_id)
-                    self.receive(j)
                     self.delete_context(data)
-                except:
-                    dbg("HTTP REQUEST CALLBACK FAILED", True)
+                    if request_metadata.should_try():
+                        self.receive(request_metadata)
+                    else:
+                        self.fail_request(request_metadata)
+                    return w.WEECHAT_RC_OK
+                self.reply_buffer.pop(request_metadata.response_id)
+                self.record_reply(request_metadata, reply_buffer)
+                self.receive_reply(data, request_metadata, j)
             # We got an empty reply and this is weird so just ditch it and retry
             else:
                 dbg("length was zero, probably a bug..")
                 self.delete_context(data)
                 self.receive(request_metadata)
-        elif return_code == -1:
-            if request_metadata.response_id not in self.reply_buffer:
-                self.reply_buffer[request_metadata.response_id] = StringIO()
-            self.reply_buffer[request_metadata.response_id].write(out)
-        else:
+        elif return_code != -1:
             self.reply_buffer.pop(request_metadata.response_id, None)
             self.delete_context(data)
             if request_metadata.request.startswith("rtm."):
@@ -734,20 +1331,71 @@ class EventRouter(object):
                     level=5,
                 )
                 self.receive(request_metadata)
+            else:
+                self.fail_request(request_metadata)
         return w.WEECHAT_RC_OK
 
     def receive(self, dataobj, slow=False):
         """
         Receives a raw object and places it on the queue for
         processing. Object must be known to handle_next or
-        be JSON.
+        be JSON. SlackRequests are handed to the request scheduler,
+        which sends them when the rate limit for their method allows it.
+        If slow is set, the request is sent after all interactive ones.
         """
         dbg("RECEIVED FROM QUEUE")
-        if slow:
-            self.slow_queue.append(dataobj)
+        if isinstance(dataobj, SlackRequest):
+            if self.coalesce_request(dataobj):
+                return
+            if slow:
+                dataobj.priority = REQUEST_PRIORITY_BACKGROUND
+            self.request_scheduler.add(dataobj)
         else:
             self.queue.append(dataobj)
 
+    def coalesce_request(self, request):
+        """
+        Folds request into an identical request which is already queued or in
+        flight, if there is one. The reply to that request will be passed on to
+        request as well. Returns True if the request was folded.
+        """
+        key = request.coalesce_key()
+        if key is None:
+            return False
+        inflight = self.inflight_requests.get(key)
+        if inflight is None:
+            self.inflight_requests[key] = request
+            return False
+        elif inflight is request:
+            return False
+        dbg("Coalescing {} into in flight request".format(request.request))
+        inflight.waiters.append(request)
+        self.coalesced_count += 1
+        return True
+
+    def finish_request(self, request):
+        """
+        Removes request from the in flight requests and returns the requests
+        which are waiting for its reply.
+        """
+        key = request.coalesce_key()
+        if key is not None and self.inflight_requests.get(key) is request:
+            del self.inflight_requests[key]
+        waiters = request.waiters
+        request.waiters = []
+        return waiters
+
+    def fail_request(self, request):
+        """
+        Gives up on request and the requests waiting for its reply. This must
+        be called whenever a request is dropped without a reply, so the next
+        identical request is sent instead of being coalesced into this one.
+        """
+        dbg("Giving up on {}".format(request.request), level=4)
+        for failed in [request] + self.finish_request(request):
+            if "batch" in failed.metadata:
+                failed.team.user_resolver.request_failed(failed)
+
     def handle_next(self):
         """
         complete
@@ -756,7 +1404,7 @@ class EventRouter(object):
         useful metadata and context to events as they are processed.
         """
         wanted_interval = 100
-        if len(self.slow_queue) > 0 or len(self.queue) > 0:
+        if len(self.request_scheduler) > 0 or len(self.queue) > 0:
             wanted_interval = 10
         if (
             self.handle_next_hook is None
@@ -769,73 +1417,105 @@ class EventRouter(object):
             )
             self.handle_next_hook_interval = wanted_interval
 
-        if len(self.slow_queue) > 0 and ((self.slow_queue_timer + 1) < time.time()):
-            dbg("from slow queue", 0)
-            self.queue.append(self.slow_queue.pop())
-            self.slow_queue_timer = time.time()
-        if len(self.queue) > 0:
-            j = self.queue.pop(0)
-            # Reply is a special case of a json reply from websocket.
-            if isinstance(j, SlackRequest):
-                if j.should_try():
-                    if j.retry_ready():
-                        local_process_async_slack_api_request(j, self)
-                    else:
-                        self.slow_queue.append(j)
+        # Process as many events as fit in the time budget for this tick, but
+        # always at least one, so a budget of 0 drains one event per tick.
+        self.queue_depth_max = max(self.queue_depth_max, len(self.queue))
+        deadline = time.time() + config.event_drain_budget / 1000.0
+        processed = 0
+        try:
+            for request in self.request_scheduler.ready_requests():
+                processed += 1
+                self.handle_event(request)
+            while self.queue:
+                j = self.queue.popleft()
+                processed += 1
+                self.handle_event(j)
+                if time.time() >= deadline:
+                    break
+        finally:
+            self.update_drain_stats(processed)
+            # Also when handling an event failed, so the changes made before
+            # it are still shown
+            self.weechat_controller.update_changed_messages()
+            self.weechat_controller.update_nicklists()
+
+    def update_drain_stats(self, processed):
+        """
+        Updates the counters shown by /slack queue. The drain rate is
+        recalculated at most once per second.
+        """
+        now = time.time()
+        self.events_processed += processed
+        self.events_processed_last_tick = processed
+        elapsed = now - self.drain_rate_time
+        if elapsed >= 1:
+            self.drain_rate = (self.events_processed - self.drain_rate_count) / elapsed
+            self.drain_rate_time = now
+            self.drain_rate_count = self.events_processed
+
+    def handle_event(self, j):
+        """
+        Dispatches a single item taken off the queue, either by sending it
+        if it is a SlackRequest, or by running the process/handle function
+        for it if it is JSON.
+        """
+        # Reply is a special case of a json reply from websocket.
+        if isinstance(j, SlackRequest):
+            if j.should_try():
+                if j.retry_ready():
+                    local_process_async_slack_api_request(j, self)
                 else:
-                    dbg("Max retries for Slackrequest")
-
+                    self.request_scheduler.add(j)
             else:
+                dbg("Max retries for Slackrequest")
+                self.fail_request(j)
 
-                if "reply_to" in j:
-                    dbg("SET FROM REPLY")
-                    function_name = "reply"
-                elif "type" in j:
-                    dbg("SET FROM type")
-                    function_name = j["type"]
-                elif "wee_slack_process_method" in j:
-                    dbg("SET FROM META")
-                    function_name = j["wee_slack_process_method"]
-                else:
-                    dbg("SET FROM NADA")
-                    function_name = "unknown"
-
-                request = j.get("wee_slack_request_metadata")
-                if request:
-                    team = request.team
-                    channel = request.channel
-                    metadata = request.metadata
-                else:
-                    team = j.get("wee_slack_metadata_team")
-                    channel = None
-                    metadata = {}
-
-                if team:
-                    if "channel" in j:
-                        channel_id = (
-                            j["channel"]["id"]
-                            if type(j["channel"]) == dict
-                            else j["channel"]
-                        )
-                        channel = team.channels.get(channel_id, channel)
-                    if "user" in j:
-                        user_id = (
-                            j["user"]["id"] if type(j["user"]) == dict else j["user"]
-                        )
-                        metadata["user"] = team.users.get(user_id)
+        else:
 
-                dbg("running {}".format(function_name))
-                if (
-                    function_name.startswith("local_")
-                    and function_name in self.local_proc
-                ):
-                    self.local_proc[function_name](j, self, team, channel, metadata)
-                elif function_name in self.proc:
-                    self.proc[function_name](j, self, team, channel, metadata)
-                elif function_name in self.handlers:
-                    self.handlers[function_name](j, self, team, channel, metadata)
-                else:
-                    dbg("Callback not implemented for event: {}".format(function_name))
+            if "reply_to" in j:
+                dbg("SET FROM REPLY")
+                function_name = "reply"
+            elif "type" in j:
+                dbg("SET FROM type")
+                function_name = j["type"]
+            elif "wee_slack_process_method" in j:
+                dbg("SET FROM META")
+                function_name = j["wee_slack_process_method"]
+            else:
+                dbg("SET FROM NADA")
+                function_name = "unknown"
+
+            request = j.get("wee_slack_request_metadata")
+            if request:
+                team = request.team
+                channel = request.channel
+                metadata = request.metadata
+            else:
+                team = j.get("wee_slack_metadata_team")
+                channel = None
+                metadata = {}
+
+            if team:
+                if "channel" in j:
+                    channel_id = (
+                        j["channel"]["id"]
+                        if type(j["channel"]) == dict
+                        else j["channel"]
+                    )
+                    channel = team.channels.get(channel_id, channel)
+                if "user" in j:
+                    user_id = j["user"]["id"] if type(j["user"]) == dict else j["user"]
+                    metadata["user"] = team.users.get(user_id)
+
+            dbg("running {}".format(function_name))
+            if function_name.startswith("local_") and function_name in self.local_proc:
+                self.local_proc[function_name](j, self, team, channel, metadata)
+            elif function_name in self.proc:
+                self.proc[function_name](j, self, team, channel, metadata)
+            elif function_name in self.handlers:
+                self.handlers[function_name](j, self, team, channel, metadata)
+            else:
+                dbg("Callback not implemented for event: {}".format(function_name))
 
 
 def handle_next(data, remaining_calls):
@@ -858,6 +1538,17 @@ class WeechatController(object):
         self.eventrouter = eventrouter
         self.buffers = {}
         self.previous_buffer = None
+        # Buffers which need to be refreshed, and a heap of (expire time,
+        # buffer) for typing notices, so the timers don't have to go through
+        # all buffers to find the few that changed
+        self.dirty_buffers = set()
+        self.typing_expiry = []
+        # Channels with changed messages, which are rendered again at most
+        # once per message_update_interval, so a burst of reactions or
+        # replies to a message only updates its lines once
+        self.changed_channels = []
+        self.next_update_time = 0
+        self.nicklist_channels = []
 
     def iter_buffers(self):
         for b in self.buffers:
@@ -882,6 +1573,7 @@ class WeechatController(object):
         if channel:
             channel.destroy_buffer(update_remote)
             del self.buffers[buffer_ptr]
+            self.dirty_buffers.discard(buffer_ptr)
             if close_buffer:
                 w.buffer_close(buffer_ptr)
 
@@ -894,6 +1586,81 @@ class WeechatController(object):
     def get_previous_buffer_ptr(self):
         return self.previous_buffer
 
+    def mark_dirty(self, buffer_ptr):
+        self.dirty_buffers.add(buffer_ptr)
+
+    def pop_dirty_channels(self):
+        dirty_buffers = self.dirty_buffers
+        self.dirty_buffers = set()
+        for buffer_ptr in dirty_buffers:
+            channel = self.buffers.get(buffer_ptr)
+            if channel:
+                yield channel
+
+    def messages_changed(self, channel):
+        self.changed_channels.append(channel)
+
+    def update_changed_messages(self):
+        """
+        Renders the changed messages again, at most once per
+        message_update_interval. The first change after the interval has
+        passed is shown right away, and the ones coming in during the
+        interval are shown together when it ends.
+        """
+        if not self.changed_channels:
+            return
+        now = time.time()
+        if now < self.next_update_time:
+            return
+        self.next_update_time = now + config.message_update_interval / 1000.0
+        changed_channels = self.changed_channels
+        self.changed_channels = []
+        for channel in changed_channels:
+            channel.update_changed_messages()
+
+    def nicklist_pending(self, channel):
+        self.nicklist_channels.append(channel)
+
+    def update_nicklists(self):
+        """
+        Applies pending nicklist updates, at most NICKLIST_BATCH_SIZE of them
+        in total for all channels.
+        """
+        budget = NICKLIST_BATCH_SIZE
+        channels = self.nicklist_channels
+        self.nicklist_channels = []
+        for channel in channels:
+            if budget > 0:
+                budget -= channel.sync_nicklist(budget)
+            if channel.nicklist_queue:
+                self.nicklist_channels.append(channel)
+
+    def typing_started(self, buffer_ptr, typing_time):
+        heapq.heappush(self.typing_expiry, (typing_time + TYPING_DURATION, buffer_ptr))
+
+    def expire_typing(self):
+        """
+        Marks the buffers where a typing notice expired as dirty. Returns
+        True if any typing notice expired.
+        """
+        now = time.time()
+        expired = False
+        while self.typing_expiry and self.typing_expiry[0][0] <= now:
+            _, buffer_ptr = heapq.heappop(self.typing_expiry)
+            self.mark_dirty(buffer_ptr)
+            expired = True
+        return expired
+
+    def typing_channels(self):
+        """
+        Returns the channels which may have someone typing, i.e. the ones
+        with a typing notice that hasn't expired yet.
+        """
+        buffer_ptrs = OrderedDict.fromkeys(
+            buffer_ptr for _, buffer_ptr in self.typing_expiry
+        )
+        return [self.buffers[b] for b in buffer_ptrs if b in self.buffers]
+
     def set_previous_buffer(self, data):
         self.previous_buffer = data
 
@@ -914,9 +1681,14 @@ def local_process_async_slack_api_request(request, event_router):
                 random.choice(string.ascii_uppercase + string.digits) for _ in range(4)
             )
         )
-        params = {"useragent": "wee_slack {}".format(SCRIPT_VERSION)}
+        params = request.params
         request.tried()
         context = event_router.store_context(request)
+        if config.http_connection_pool:
+            event_router.get_connection_pool().submit_request(
+                context, request, event_router.receive_httprequest_callback
+            )
+            return
         # TODO: let flashcode know about this bug - i have to 'clear' the hashtable or retry requests fail
         w.hook_process_hashtable("url:", params, config.slack_timeout, "", context)
         w.hook_process_hashtable(
@@ -926,6 +1698,8 @@ def local_process_async_slack_api_request(request, event_router):
             "receive_httprequest_callback",
             context,
         )
+    else:
+        event_router.fail_request(request)
 
 
 ###### New Callbacks
@@ -943,6 +1717,14 @@ def ws_ping_cb(data, remaining_calls):
     return w.WEECHAT_RC_OK
 
 
+@utf8_decode
+def resolve_users_cb(team_hash, remaining_calls):
+    team = EVENTROUTER.teams.get(team_hash)
+    if team:
+        team.user_resolver.flush()
+    return w.WEECHAT_RC_OK
+
+
 @utf8_decode
 def reconnect_callback(*args):
     EVENTROUTER.reconnect_if_disconnected()
@@ -994,13 +1776,8 @@ def buffer_input_callback(signal, buffer_ptr, data):
     if not channel:
         return w.WEECHAT_RC_ERROR
 
-    reaction = re.match(
-        r"{}{}\s*$".format(
-            REACTION_PREFIX_REGEX_STRING, EMOJI_CHAR_OR_NAME_REGEX_STRING
-        ),
-        data,
-    )
-    substitute = re.match("{}?s/".format(MESSAGE_ID_REGEX_STRING), data)
+    reaction = REACTION_INPUT_REGEX.match(data)
+    substitute = SUBSTITUTE_INPUT_REGEX.match(data)
     if reaction:
         emoji = reaction.group("emoji_char") or reaction.group("emoji_name")
         if reaction.group("reaction_change") == "+":
@@ -1074,10 +1851,11 @@ def buffer_list_update_callback(data, somecount):
     if needed. We only do this max 1x per second, as otherwise it
     uses a lot of cpu for minimal changes. We use buffer short names
     to indicate typing via "#channel" <-> ">channel" and
-    user presence via " name" <-> "+name".
+    user presence via " name" <-> "+name". Only the buffers which
+    were marked as dirty since the last run are refreshed.
     """
 
-    for buf in EVENTROUTER.weechat_controller.buffers.values():
+    for buf in EVENTROUTER.weechat_controller.pop_dirty_channels():
         buf.refresh()
     return w.WEECHAT_RC_OK
 
@@ -1105,7 +1883,8 @@ def typing_notification_cb(data, signal, current_buffer):
 
 @utf8_decode
 def typing_update_cb(data, remaining_calls):
-    w.bar_item_update("slack_typing_notice")
+    if EVENTROUTER.weechat_controller.expire_typing():
+        w.bar_item_update("slack_typing_notice")
     return w.WEECHAT_RC_OK
 
 
@@ -1137,11 +1916,10 @@ def typing_bar_item_cb(data, item, current_window, current_buffer, extra_info):
 
     # here is where we notify you that someone is typing in DM
     # regardless of which buffer you are in currently
-    for team in EVENTROUTER.teams.values():
-        for channel in team.channels.values():
-            if channel.type == "im":
-                if channel.is_someone_typing():
-                    typers.append("D/" + channel.name)
+    for channel in EVENTROUTER.weechat_controller.typing_channels():
+        if channel.type == "im":
+            if channel.is_someone_typing():
+                typers.append("D/" + channel.name)
 
     typing = ", ".join(typers)
     if typing != "":
@@ -1279,12 +2057,10 @@ def thread_completion_cb(data, completion_item, current_buffer, completion):
     if current_channel is None or not hasattr(current_channel, "hashed_messages"):
         return w.WEECHAT_RC_OK
 
-    threads = (
-        x for x in current_channel.hashed_messages.items() if isinstance(x[0], str)
-    )
-    for thread_id, message_ts in sorted(threads, key=lambda item: item[1]):
-        message = current_channel.messages.get(message_ts)
-        if message and message.number_of_replies():
+    # The messages are already sorted by ts, so we don't have to sort the hashes
+    for message_ts, message in current_channel.messages.items():
+        thread_id = current_channel.hashed_messages.get(message_ts)
+        if thread_id and message and message.number_of_replies():
             w.hook_completion_list_add(
                 completion, "$" + thread_id, 0, w.WEECHAT_LIST_POS_BEGINNING
             )
@@ -1399,6 +2175,7 @@ def stop_talking_to_slack():
     """
     if "EVENTROUTER" in globals():
         EVENTROUTER.shutdown()
+        EVENTROUTER.close_workers()
         for team in EVENTROUTER.teams.values():
             team.ws.shutdown()
     return w.WEECHAT_RC_OK
@@ -1434,13 +2211,19 @@ class SlackRequest(object):
         self.token = token if token else team.token
         self.tries = 0
         self.start_time = time.time()
+        self.priority = REQUEST_PRIORITY_INTERACTIVE
+        self.waiters = []
         self.request_normalized = re.sub(r"\W+", "", request)
         self.domain = "api.slack.com"
         self.post_data["token"] = self.token
         self.url = "https://{}/api/{}?{}".format(
             self.domain, self.request, urlencode(encode_to_utf8(self.post_data))
         )
-        self.params = {"useragent": "wee_slack {}".format(SCRIPT_VERSION)}
+        # Include the response headers in the output, so we can see Retry-After
+        self.params = {
+            "useragent": "wee_slack {}".format(SCRIPT_VERSION),
+            "header": "1",
+        }
         self.response_id = sha1_hex("{}{}".format(self.url, self.start_time))
 
     def __repr__(self):
@@ -1467,41 +2250,253 @@ class SlackRequest(object):
     def should_try(self):
         return self.tries < self.retries
 
+    def retry_time(self):
+        return self.start_time + (self.tries ** 2)
+
     def retry_ready(self):
-        return (self.start_time + (self.tries ** 2)) < time.time()
+        return self.retry_time() < time.time()
 
+    def rate_limit_key(self):
+        return (self.token, self.request)
 
-class SlackSubteam(object):
+    def coalesce_key(self):
+        if self.request not in SLACK_API_COALESCED_METHODS:
+            return None
+        post_data = tuple(sorted((k, str(v)) for k, v in self.post_data.items()))
+        return (self.token, self.request, post_data)
+
+
+class SlackRateLimitBucket(object):
     """
-    Represents a slack group or subteam
+    A token bucket for one API method of one team. Tokens are refilled at the
+    rate of the method's tier, and the bucket is blocked completely when Slack
+    tells us to back off with a Retry-After header.
     """
 
-    def __init__(self, originating_team_id, is_member, **kwargs):
-        self.handle = "@{}".format(kwargs["handle"])
-        self.identifier = kwargs["id"]
-        self.name = kwargs["name"]
-        self.description = kwargs.get("description")
-        self.team_id = originating_team_id
-        self.is_member = is_member
+    def __init__(self, method):
+        tier = SLACK_API_METHOD_TIERS.get(method, SLACK_API_RATE_LIMIT_DEFAULT_TIER)
+        per_minute, burst = SLACK_API_RATE_LIMIT_TIERS[tier]
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.blocked_until = 0
 
-    def __repr__(self):
-        return "Name:{} Identifier:{}".format(self.name, self.identifier)
+    def refill(self, now):
+        elapsed = max(0, now - self.last_refill)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_refill = now
 
-    def __eq__(self, compare_str):
-        return compare_str == self.identifier
+    def take(self, now, priority=REQUEST_PRIORITY_INTERACTIVE):
+        """
+        Takes a token if one is available. Background requests leave one token
+        in the bucket, so interactive requests can always go out right away.
+        """
+        if now < self.blocked_until:
+            return False
+        self.refill(now)
+        interactive = priority == REQUEST_PRIORITY_INTERACTIVE
+        reserve = 0 if interactive or self.capacity == 1 else 1
+        if self.tokens - reserve >= 1:
+            self.tokens -= 1
+            return True
+        return False
 
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+        self.last_refill = self.blocked_until
 
-class SlackTeam(object):
+
+class SlackRequestScheduler(object):
     """
-    incomplete
-    Team object under which users and channels live.. Does lots.
+    Holds SlackRequests until they can be sent. Requests are kept in one queue
+    per team, method and priority, and are released in FIFO order when the
+    token bucket for their method has a token, interactive requests first.
+    Requests which are waiting for a retry are kept in a heap until they are
+    ready.
     """
 
-    def __init__(
-        self,
-        eventrouter,
-        token,
-        team_hash,
+    def __init__(self):
+        self.buckets = {}
+        self.pending = OrderedDict()
+        self.delayed = []
+        self.delayed_counter = count()
+        self.rate_limited_count = 0
+
+    def __len__(self):
+        return len(self.delayed) + sum(
+            len(queue) for queues in self.pending.values() for queue in queues
+        )
+
+    def pending_count(self, priority):
+        return sum(len(queues[priority]) for queues in self.pending.values())
+
+    def get_bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = SlackRateLimitBucket(key[1])
+        return bucket
+
+    def add(self, request, first=False):
+        if request.tries and not request.retry_ready():
+            heapq.heappush(
+                self.delayed,
+                (request.retry_time(), next(self.delayed_counter), request),
+            )
+            return
+        key = request.rate_limit_key()
+        queues = self.pending.get(key)
+        if queues is None:
+            queues = self.pending[key] = (deque(), deque())
+        if first:
+            queues[request.priority].appendleft(request)
+        else:
+            queues[request.priority].append(request)
+
+    def ready_requests(self):
+        """
+        Returns the requests which can be sent now, and removes them from the
+        scheduler.
+        """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] < now:
+            _, _, request = heapq.heappop(self.delayed)
+            self.add(request)
+
+        ready = []
+        for key, queues in list(self.pending.items()):
+            bucket = self.get_bucket(key)
+            for priority, queue in enumerate(queues):
+                while queue and bucket.take(now, priority):
+                    ready.append(queue.popleft())
+            if not any(queues):
+                del self.pending[key]
+        ready.sort(key=lambda request: request.priority)
+        return ready
+
+    def rate_limited(self, request, retry_after):
+        """
+        Called when Slack answered a request with HTTP 429. Blocks the method
+        for retry_after seconds, and puts the request back at the front of its
+        queue without counting the attempt against its retries.
+        """
+        self.rate_limited_count += 1
+        self.get_bucket(request.rate_limit_key()).block(time.time(), retry_after)
+        request.tries = max(0, request.tries - 1)
+        self.add(request, first=True)
+
+    def blocked_methods(self):
+        now = time.time()
+        return [
+            (key[1], bucket.blocked_until - now)
+            for key, bucket in self.buckets.items()
+            if bucket.blocked_until > now
+        ]
+
+
+class SlackNameIndexedDict(dict):
+    """
+    A dict of users, channels or subteams by id, which also keeps an index
+    from their names to their ids, so they can be looked up by name without
+    going through all of them. The index is updated when an item is added or
+    replaced, and name_changed must be called when an item is renamed. As
+    before, if several items have the same name, the last one wins.
+
+    The name each item was indexed under is kept in names_by_id, so it's
+    removed from the index even if the item has changed, like a stub which
+    forwards to its channel once that's created.
+    """
+
+    def __init__(self, name_attribute="name"):
+        super(SlackNameIndexedDict, self).__init__()
+        self.name_attribute = name_attribute
+        self.ids_by_name = {}
+        self.names_by_id = {}
+        self.shared_names = set()
+
+    def __setitem__(self, key, value):
+        name = self.item_name(value)
+        old_name = self.unindex_name(key)
+        dict.__setitem__(self, key, value)
+        self.index_name(key, name)
+        # Replacing an item with one of the same name, like when a stub is
+        # replaced by its channel, doesn't change any references
+        if name != old_name:
+            invalidate_resolved_refs()
+
+    def __delitem__(self, key):
+        self.unindex_name(key)
+        dict.__delitem__(self, key)
+        invalidate_resolved_refs()
+
+    def item_name(self, item):
+        return getattr(item, self.name_attribute)
+
+    def name_changed(self, key, item):
+        if dict.get(self, key) is item:
+            self.unindex_name(key)
+            self.index_name(key, self.item_name(item))
+            invalidate_resolved_refs()
+
+    def index_name(self, key, name):
+        if self.ids_by_name.get(name, key) != key:
+            self.shared_names.add(name)
+        self.ids_by_name[name] = key
+        self.names_by_id[key] = name
+
+    def unindex_name(self, key):
+        """
+        Removes the name key was indexed under from the index, and returns it.
+        """
+        name = self.names_by_id.pop(key, None)
+        if name is None or self.ids_by_name.get(name) != key:
+            return name
+        del self.ids_by_name[name]
+        if name in self.shared_names:
+            # Fall back to another item with the same name, if there is one
+            self.shared_names.discard(name)
+            others = [
+                other_key
+                for other_key, other_name in self.names_by_id.items()
+                if other_name == name
+            ]
+            for other_key in others:
+                self.index_name(other_key, name)
+        return name
+
+
+class SlackSubteam(object):
+    """
+    Represents a slack group or subteam
+    """
+
+    def __init__(self, originating_team_id, is_member, **kwargs):
+        self.handle = "@{}".format(kwargs["handle"])
+        self.identifier = kwargs["id"]
+        self.name = kwargs["name"]
+        self.description = kwargs.get("description")
+        self.team_id = originating_team_id
+        self.is_member = is_member
+
+    def __repr__(self):
+        return "Name:{} Identifier:{}".format(self.name, self.identifier)
+
+    def __eq__(self, compare_str):
+        return compare_str == self.identifier
+
+
+class SlackTeam(object):
+    """
+    incomplete
+    Team object under which users and channels live.. Does lots.
+    """
+
+    def __init__(
+        self,
+        eventrouter,
+        token,
+        team_hash,
         websocket_url,
         team_info,
         subteams,
@@ -1547,15 +2542,16 @@ class SlackTeam(object):
             self.channels = channels
         self.users = users
         self.bots = bots
+        self.user_resolver = SlackUserResolver(self)
         self.channel_buffer = None
         self.got_history = True
         self.history_needs_update = False
         self.create_buffer()
         self.set_muted_channels(kwargs.get("muted_channels", ""))
         self.set_highlight_words(kwargs.get("highlight_words", ""))
-        for c in self.channels.keys():
-            channels[c].set_related_server(self)
-            channels[c].check_should_open()
+        for channel in self.channels.values():
+            channel.set_related_server(self)
+            channel.check_should_open()
         # Last step is to make sure my nickname is the set color
         self.users[self.myidentifier].force_color(
             w.config_string(w.config_get("weechat.color.chat_nick_self"))
@@ -1578,17 +2574,31 @@ class SlackTeam(object):
         return self.users.keys()
 
     def load_emoji_completions(self):
-        self.emoji_completions = list(EMOJI.keys())
-        if self.emoji_completions:
+        # The custom emoji from the last emoji.list are read from the cache
+        # when they are first completed, until the new list arrives
+        self.custom_emoji = None
+        if os.path.exists(get_weemoji_path()):
             s = SlackRequest(self, "emoji.list")
-            self.eventrouter.receive(s)
+            self.eventrouter.receive(s, slow=True)
+
+    @property
+    def emoji_completions(self):
+        if not get_emoji():
+            return []
+        if self.custom_emoji is None:
+            self.custom_emoji = read_cache("emoji_" + self.identifier) or []
+        return chain(EMOJI.keys(), self.custom_emoji)
+
+    def set_custom_emoji(self, custom_emoji):
+        self.custom_emoji = custom_emoji
+        write_cache("emoji_" + self.identifier, custom_emoji)
 
     def add_channel(self, channel):
         self.channels[channel["id"]] = channel
         channel.set_related_server(self)
 
     def generate_usergroup_map(self):
-        return {s.handle: s.identifier for s in self.subteams.values()}
+        return ReadOnlyMapping(self.subteams.ids_by_name)
 
     def set_name(self):
         alias = config.server_aliases.get(self.subdomain)
@@ -1648,17 +2658,18 @@ class SlackTeam(object):
         w.prnt("", "ERROR: Sending a message in the team buffer is not supported")
 
     def find_channel_by_members(self, members, channel_type=None):
-        for channel in self.channels.values():
-            if channel.members == members and (
-                channel_type is None or channel.type == channel_type
-            ):
-                return channel
+        """
+        Finds the DM or MPDM with exactly these members.
+        """
+        channel = self.channels.get_by_members(members)
+        if channel and (channel_type is None or channel.type == channel_type):
+            return channel
 
     def get_channel_map(self):
-        return {v.name: k for k, v in self.channels.items()}
+        return ReadOnlyMapping(self.channels.ids_by_name)
 
     def get_username_map(self):
-        return {v.name: k for k, v in self.users.items()}
+        return ReadOnlyMapping(self.users.ids_by_name)
 
     def get_team_hash(self):
         return self.team_hash
@@ -1730,8 +2741,8 @@ class SlackTeam(object):
                 self.set_connected()
             elif not self.connecting_rtm:
                 # The fast reconnect failed, so start over-ish
-                for chan in self.channels:
-                    self.channels[chan].history_needs_update = True
+                for channel in self.channels.values():
+                    channel.history_needs_update = True
                 s = initiate_connection(
                     self.token, retries=999, team=self, reconnect=reconnect
                 )
@@ -1787,11 +2798,9 @@ class SlackTeam(object):
     def update_member_presence(self, user, presence):
         user.presence = presence
 
-        for c in self.channels:
-            c = self.channels[c]
-            if user.id in c.members:
-                c.buffer_name_needs_update = True
-                c.update_nicklist(user.id)
+        for c in self.channels.with_member(user.identifier):
+            c.mark_for_refresh()
+            c.update_nicklist(user.identifier)
 
     def subscribe_users_presence(self):
         # FIXME: There is a limitation in the API to the size of the
@@ -1810,6 +2819,165 @@ class SlackTeam(object):
         )
 
 
+class SlackUserResolver(object):
+    """
+    Collects the ids of users the team doesn't know about yet and resolves
+    them in batches. Ids are collected for USER_RESOLVE_DELAY ms. Large
+    batches fetch the paginated users.list first, and only the users not in
+    it (e.g. external users) are looked up with users.info. Users of shared
+    channels aren't counted for this, since external users aren't in
+    users.list. The nicklists of the channels which asked for the users are
+    updated once the whole batch is resolved.
+
+    Slack has no way to look up many external users at once, so at most
+    USER_RESOLVE_INFO_LIMIT users are looked up with users.info per batch.
+    The others aren't shown in the nicklist of a shared channel until they
+    are resolved some other way, e.g. by opening a DM with them.
+    """
+
+    def __init__(self, team):
+        self.team = team
+        self.pending = set()
+        self.pending_shared = set()
+        # Channels aren't hashable, so these are dicts by id
+        self.pending_channels = {}
+        self.batch = set()
+        self.batch_channels = {}
+        self.batch_id = 0
+        self.batch_time = 0
+        self.outstanding = 0
+        self.timer = None
+        self.have_users_list = False
+
+    def resolve(self, user_ids, channel=None):
+        unknown_ids = {
+            user_id for user_id in user_ids if user_id not in self.team.users
+        }
+        new_ids = unknown_ids - self.batch
+        if channel and new_ids:
+            self.pending_channels[channel.identifier] = channel
+        elif channel and unknown_ids:
+            # All the users are in the current batch already, so update the
+            # channel when it's done
+            self.batch_channels[channel.identifier] = channel
+        if not new_ids:
+            return
+        self.pending |= new_ids
+        if channel and channel.type == "shared":
+            self.pending_shared |= new_ids
+        self.schedule()
+
+    def schedule(self):
+        if not self.timer:
+            self.timer = w.hook_timer(
+                USER_RESOLVE_DELAY, 0, 1, "resolve_users_cb", self.team.team_hash
+            )
+
+    def flush(self):
+        self.timer = None
+        if self.outstanding:
+            if time.time() - self.batch_time < USER_RESOLVE_TIMEOUT:
+                # Wait for the current batch, it will flush again when done.
+                # Keep the timer running so the timeout is still noticed.
+                self.schedule()
+                return
+            dbg("Timed out resolving users {}".format(self.batch), level=4)
+            self.finish_batch()
+
+        self.batch = self.pending - set(self.team.users)
+        self.batch_channels = self.pending_channels
+        listed = self.batch - self.pending_shared
+        self.pending = set()
+        self.pending_shared = set()
+        self.pending_channels = {}
+        self.batch_id += 1
+        self.batch_time = time.time()
+
+        if len(listed) >= USER_RESOLVE_LIST_THRESHOLD and not self.have_users_list:
+            self.request_users_list()
+        else:
+            self.request_users_info(self.batch)
+
+    def request_users_list(self, cursor=None):
+        post_data = {"limit": 1000}
+        if cursor:
+            post_data["cursor"] = cursor
+        s = SlackRequest(
+            self.team, "users.list", post_data, metadata={"batch": self.batch_id}
+        )
+        self.outstanding += 1
+        self.team.eventrouter.receive(s, slow=True)
+
+    def request_users_info(self, user_ids):
+        user_ids = sorted(
+            user_id for user_id in user_ids if user_id not in self.team.users
+        )
+        if len(user_ids) > USER_RESOLVE_INFO_LIMIT:
+            dbg(
+                "Not looking up {} unknown users".format(
+                    len(user_ids) - USER_RESOLVE_INFO_LIMIT
+                ),
+                level=4,
+            )
+            user_ids = user_ids[:USER_RESOLVE_INFO_LIMIT]
+        for user_id in user_ids:
+            s = SlackRequest(
+                self.team,
+                "users.info",
+                {"user": user_id},
+                metadata={"batch": self.batch_id},
+            )
+            self.outstanding += 1
+            self.team.eventrouter.receive(s, slow=True)
+        if not self.outstanding:
+            self.finish_batch()
+
+    def users_list_received(self, batch_id, next_cursor):
+        if batch_id != self.batch_id:
+            return
+        self.outstanding -= 1
+        if next_cursor:
+            self.request_users_list(next_cursor)
+        else:
+            self.have_users_list = True
+            self.request_users_info(self.batch)
+
+    def users_list_failed(self, batch_id):
+        if batch_id != self.batch_id:
+            return
+        # Look up the users one by one instead
+        self.outstanding -= 1
+        self.request_users_info(self.batch)
+
+    def user_received(self, batch_id):
+        if batch_id != self.batch_id:
+            return
+        self.outstanding -= 1
+        if not self.outstanding:
+            self.finish_batch()
+
+    def request_failed(self, request):
+        """
+        Called for batch requests which were given up on without a reply.
+        """
+        if request.request == "users.list":
+            self.users_list_failed(request.metadata["batch"])
+        else:
+            self.user_received(request.metadata["batch"])
+
+    def finish_batch(self):
+        self.outstanding = 0
+        self.batch = set()
+        channels = self.batch_channels
+        self.batch_channels = {}
+        for channel in channels.values():
+            if channel.type == "mpim":
+                channel.set_name(channel.name_from_members())
+            channel.update_nicklist()
+        if self.pending:
+            self.schedule()
+
+
 class SlackChannelCommon(object):
     def __init__(self):
         self.label_full_drop_prefix = False
@@ -1817,6 +2985,23 @@ class SlackChannelCommon(object):
         self.label_short_drop_prefix = False
         self.label_short = None
         self.buffer_rename_in_progress = False
+        self.channel_buffer = None
+        self.forget_printed_messages()
+
+    def forget_printed_messages(self):
+        # The ts of the messages printed in the buffer, so reprint_messages
+        # can print only the missing ones when possible
+        self.printed_ts = set()
+        self.last_printed_ts = None
+        self.history_notice_printed = False
+        # The pointer and position of the last line of each printed message,
+        # so modify_buffer_line doesn't have to search the buffer for them
+        self.line_positions = {}
+
+    def mark_for_refresh(self):
+        self.buffer_name_needs_update = True
+        if self.channel_buffer:
+            self.eventrouter.weechat_controller.mark_dirty(self.channel_buffer)
 
     def prnt_message(
         self, message, history_message=False, no_log=False, force_render=False
@@ -1864,9 +3049,18 @@ class SlackChannelCommon(object):
             no_log=no_log,
             extra_tags=extra_tags,
         )
+        if self.channel_buffer:
+            self.printed_ts.add(message.ts)
+            if self.last_printed_ts is None or message.ts > self.last_printed_ts:
+                self.last_printed_ts = message.ts
 
     def print_getting_history(self):
-        if self.channel_buffer:
+        # Lines can't be removed from a buffer, so the notice is only printed
+        # while no messages are shown. Once they are, removing it would mean
+        # clearing and reprinting the buffer when the history arrives, instead
+        # of just printing the new messages.
+        if self.channel_buffer and not self.printed_ts:
+            self.history_notice_printed = True
             ts = SlackTS()
             w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
             w.prnt_date_tags(
@@ -1879,17 +3073,50 @@ class SlackChannelCommon(object):
 
     def reprint_messages(self, history_message=False, no_log=True, force_render=False):
         if self.channel_buffer:
-            w.buffer_clear(self.channel_buffer)
-            self.last_line_from = None
-            for message in self.visible_messages.values():
-                self.prnt_message(message, history_message, no_log, force_render)
-            if (
+            if force_render or not self.print_missing_messages(history_message, no_log):
+                w.buffer_clear(self.channel_buffer)
+                self.last_line_from = None
+                self.forget_printed_messages()
+                for message in self.visible_messages.values():
+                    self.prnt_message(message, history_message, no_log, force_render)
+            if force_render:
+                self.refetch_dropped_messages(self.visible_messages.values())
+            if not self.history_notice_printed and (
                 self.identifier in self.pending_history_requests
                 or config.thread_messages_in_channel
                 and self.pending_history_requests
             ):
                 self.print_getting_history()
 
+    def print_missing_messages(self, history_message, no_log):
+        """
+        Prints the visible messages which aren't in the buffer yet, if they
+        are all newer than the last printed message so they can be added at
+        the end. Returns False if the buffer has to be cleared and reprinted
+        instead, i.e. if older messages are missing, printed messages are no
+        longer visible, or the getting history notice has to be removed. The
+        notice is only printed in a buffer without messages, so clearing it
+        is cheap.
+        """
+        if self.history_notice_printed:
+            return False
+
+        new_messages = []
+        for message in reversed(self.visible_messages.values()):
+            if self.last_printed_ts is not None and message.ts <= self.last_printed_ts:
+                break
+            new_messages.append(message)
+
+        old_messages_count = len(self.visible_messages) - len(new_messages)
+        if old_messages_count != len(self.printed_ts) or any(
+            ts not in self.visible_messages for ts in self.printed_ts
+        ):
+            return False
+
+        for message in reversed(new_messages):
+            self.prnt_message(message, history_message, no_log)
+        return True
+
     def send_message(self, message, subtype=None, request_dict_ext={}):
         if subtype == "me_message":
             message = linkify_text(message, self.team, escape_characters=False)
@@ -1942,10 +3169,7 @@ class SlackChannelCommon(object):
         self.eventrouter.receive(s)
 
     def edit_nth_previous_message(self, msg_id, old, new, flags):
-        message_filter = (
-            lambda message: message.user_identifier == self.team.myidentifier
-        )
-        message = self.message_from_hash_or_index(msg_id, message_filter)
+        message = self.message_from_hash_or_index(msg_id, self.is_own_message)
         if message is None:
             if msg_id:
                 print_error(
@@ -1991,7 +3215,17 @@ class SlackChannelCommon(object):
             return
         return message
 
+    def is_own_message(self, message):
+        return message.user_identifier == self.team.myidentifier
+
     def message_from_index(self, index, message_filter=None, reverse=True):
+        if isinstance(self.visible_messages, SlackChannelVisibleMessages) and (
+            message_filter in (None, self.is_own_message)
+        ):
+            ts = self.visible_messages.ts_from_index(
+                index, reverse, own=message_filter is not None
+            )
+            return self.messages.get(ts)
         for ts in reversed(self.visible_messages) if reverse else self.visible_messages:
             message = self.messages[ts]
             if not message_filter or message_filter(message):
@@ -2019,17 +3253,37 @@ class SlackChannelCommon(object):
         if not m:
             return
         if message_json:
-            m.message_json.update(message_json)
+            m.update_json(message_json)
         if text:
             m.change_text(text)
+        m.rendered_text = None
+        self.drop_json_over_budget(m)
+
+        if not self.changed_messages:
+            self.eventrouter.weechat_controller.messages_changed(self)
+        self.changed_messages.add(ts)
 
+    def update_changed_messages(self):
+        """
+        Renders the messages passed to change_message since the last call
+        again, and updates their lines in the channel and thread buffers.
+        """
+        changed_messages = self.changed_messages
+        self.changed_messages = set()
+        for ts in sorted(changed_messages):
+            m = self.messages.get(ts)
+            if m:
+                self.update_message_lines(m)
+
+    def update_message_lines(self, m):
+        ts = m.ts
         if (
             type(m) == SlackMessage
             or m.subtype == "thread_broadcast"
             or config.thread_messages_in_channel
         ):
             new_text = self.render(m, force=True)
-            modify_buffer_line(self.channel_buffer, ts, new_text)
+            modify_buffer_line(self.channel_buffer, ts, new_text, self.line_positions)
         if type(m) == SlackThreadMessage or m.thread_channel is not None:
             thread_channel = (
                 m.parent_message.thread_channel
@@ -2038,7 +3292,12 @@ class SlackChannelCommon(object):
             )
             if thread_channel and thread_channel.active:
                 new_text = thread_channel.render(m, force=True)
-                modify_buffer_line(thread_channel.channel_buffer, ts, new_text)
+                modify_buffer_line(
+                    thread_channel.channel_buffer,
+                    ts,
+                    new_text,
+                    thread_channel.line_positions,
+                )
 
     def mark_read(self, ts=None, update_remote=True, force=False, post_data={}):
         if self.new_messages or force:
@@ -2062,6 +3321,7 @@ class SlackChannelCommon(object):
         self.channel_buffer = None
         self.got_history = False
         self.active = False
+        self.forget_printed_messages()
 
 
 class SlackChannel(SlackChannelCommon):
@@ -2082,15 +3342,20 @@ class SlackChannel(SlackChannelCommon):
         self.slack_purpose = kwargs.get("purpose", {"value": ""})
         self.topic = kwargs.get("topic", {"value": ""})
         self.last_read = SlackTS(kwargs.get("last_read", 0))
-        self.channel_buffer = None
         self.got_history = False
         self.got_members = False
         self.history_needs_update = False
         self.pending_history_requests = set()
-        self.messages = OrderedDict()
+        self.messages = SlackChannelMessages()
         self.visible_messages = SlackChannelVisibleMessages(self)
         self.hashed_messages = SlackChannelHashedMessages(self)
         self.thread_channels = {}
+        self.changed_messages = set()
+        # The name, color and group of the nicks shown in the nicklist, by
+        # user id, and the users which may have to be updated in it
+        self.nicklist_nicks = {}
+        self.nicklist_queue = deque()
+        self.nicklist_cleared = False
         self.new_messages = False
         self.typing = {}
         # short name relates to the localvar we change for typing indication
@@ -2120,7 +3385,9 @@ class SlackChannel(SlackChannelCommon):
     def set_name(self, slack_name):
         self.slack_name = slack_name
         self.name = self.formatted_name()
-        self.buffer_name_needs_update = True
+        self.mark_for_refresh()
+        if self.team:
+            self.team.channels.name_changed(self.identifier, self)
 
     def refresh(self):
         typing = self.is_someone_typing()
@@ -2145,9 +3412,15 @@ class SlackChannel(SlackChannelCommon):
             self.buffer_rename_in_progress = False
 
     def set_members(self, members):
+        old_members = set(getattr(self, "members", ()))
         self.members = set(members)
+        self.members_changed(self.members - old_members, old_members - self.members)
         self.update_nicklist()
 
+    def members_changed(self, added=(), removed=()):
+        if self.team:
+            self.team.channels.members_changed(self.identifier, self, added, removed)
+
     def set_unread_count_display(self, count):
         self.unread_count_display = count
         self.new_messages = bool(self.unread_count_display)
@@ -2235,7 +3508,10 @@ class SlackChannel(SlackChannelCommon):
 
     def update_from_message_json(self, message_json):
         for key, value in message_json.items():
-            setattr(self, key, value)
+            if key == "members":
+                self.set_members(value)
+            else:
+                setattr(self, key, value)
 
     def open(self, update_remote=True):
         if update_remote:
@@ -2361,7 +3637,10 @@ class SlackChannel(SlackChannelCommon):
 
     def destroy_buffer(self, update_remote):
         super(SlackChannel, self).destroy_buffer(update_remote)
-        self.messages = OrderedDict()
+        self.messages = SlackChannelMessages()
+        self.nicklist_nicks = {}
+        self.nicklist_queue = deque()
+        self.nicklist_cleared = False
         if update_remote and not self.eventrouter.shutting_down:
             s = SlackRequest(
                 self.team,
@@ -2416,6 +3695,7 @@ class SlackChannel(SlackChannelCommon):
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
             w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+            self.line_positions[ts] = hdata_last_line_position(self.channel_buffer)
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
             if backlog or self_msg:
@@ -2430,7 +3710,8 @@ class SlackChannel(SlackChannelCommon):
             message_to_store.submessages = old_message.submessages
 
         self.messages[message_to_store.ts] = message_to_store
-        self.messages = OrderedDict(sorted(self.messages.items()))
+        self.visible_messages.message_stored(message_to_store)
+        self.drop_json_over_budget(message_to_store)
 
         max_history = w.config_integer(
             w.config_get("weechat.history.max_buffer_lines_number")
@@ -2462,11 +3743,77 @@ class SlackChannel(SlackChannelCommon):
                 del self.hashed_messages[ts]
                 del self.hashed_messages[message_hash]
             del self.messages[ts]
+            self.visible_messages.message_removed(ts)
+
+    def drop_json_over_budget(self, message):
+        """
+        Drops the json of message and of the other messages which aren't
+        among the newest message_json_budget ones. Going from the newest to
+        the oldest, all messages past the first one whose json was dropped
+        have been dropped before, so the loop stops there.
+        """
+        budget = config.message_json_budget
+        if not budget or len(self.messages) <= budget:
+            return
+        if message.ts < self.messages.key_at(-budget):
+            message.drop_json()
+        for ts in islice(reversed(self.messages), budget, None):
+            old_message = self.messages[ts]
+            if old_message.rendered_body is not None:
+                break
+            old_message.drop_json()
+
+    def refetch_dropped_messages(self, messages):
+        """
+        Fetches the json of the messages whose json has been dropped (see
+        drop_json) again, so they are rendered with the current settings.
+        The messages of the channel are fetched with one paged history
+        request over their range, and thread replies with one per thread.
+        """
+        ranges = {}
+        for message in messages:
+            if message.rendered_body is None:
+                continue
+            if (
+                type(message) == SlackThreadMessage
+                and message.subtype != "thread_broadcast"
+            ):
+                thread_ts = message.thread_ts
+            else:
+                thread_ts = None
+            oldest, latest = ranges.get(thread_ts, (message.ts, message.ts))
+            ranges[thread_ts] = (min(oldest, message.ts), max(latest, message.ts))
+        for thread_ts, (oldest, latest) in ranges.items():
+            self.request_refetch(thread_ts, oldest, latest)
+
+    def request_refetch(self, thread_ts, oldest, latest, cursor=None):
+        post_data = {
+            "channel": self.identifier,
+            "oldest": oldest,
+            "latest": latest,
+            "inclusive": True,
+            "limit": config.history_fetch_count,
+        }
+        if thread_ts:
+            method = "conversations.replies"
+            post_data["ts"] = thread_ts
+        else:
+            method = self.team.slack_api_translator[self.type]["history"]
+        if cursor:
+            post_data["cursor"] = cursor
+        s = SlackRequest(
+            self.team,
+            method,
+            post_data,
+            channel=self,
+            metadata={"refetch": (thread_ts, oldest, latest)},
+        )
+        self.eventrouter.receive(s, slow=True)
 
     def is_visible(self):
         return w.buffer_get_integer(self.channel_buffer, "hidden") == 0
 
-    def get_members(self):
+    def get_members(self, slow_queue=False):
         if not self.got_members:
             # Slack has started returning only a few members for some channels
             # in rtm.start. I don't know how we can check if the member list is
@@ -2477,7 +3824,7 @@ class SlackChannel(SlackChannelCommon):
                 {"channel": self.identifier, "limit": 1000},
                 channel=self,
             )
-            self.eventrouter.receive(s)
+            self.eventrouter.receive(s, slow_queue)
 
     def get_history(self, slow_queue=False, full=False, no_log=False):
         if self.identifier in self.pending_history_requests:
@@ -2485,7 +3832,7 @@ class SlackChannel(SlackChannelCommon):
 
         self.print_getting_history()
         self.pending_history_requests.add(self.identifier)
-        self.get_members()
+        self.get_members(slow_queue)
 
         post_data = {"channel": self.identifier, "count": config.history_fetch_count}
         if self.got_history and self.messages and not full:
@@ -2530,8 +3877,12 @@ class SlackChannel(SlackChannelCommon):
     # Typing related
     def set_typing(self, user):
         if self.channel_buffer and self.is_visible():
-            self.typing[user.name] = time.time()
-            self.buffer_name_needs_update = True
+            typing_time = time.time()
+            self.typing[user.name] = typing_time
+            self.mark_for_refresh()
+            self.eventrouter.weechat_controller.typing_started(
+                self.channel_buffer, typing_time
+            )
 
     def is_someone_typing(self):
         """
@@ -2553,7 +3904,7 @@ class SlackChannel(SlackChannelCommon):
         """
         typing_expire_time = time.time() - TYPING_DURATION
         typing = []
-        for user, timestamp in self.typing.items():
+        for user, timestamp in list(self.typing.items()):
             if timestamp > typing_expire_time:
                 typing.append(user)
             else:
@@ -2563,113 +3914,117 @@ class SlackChannel(SlackChannelCommon):
     def user_joined(self, user_id):
         # ugly hack - for some reason this gets turned into a list
         self.members = set(self.members)
-        self.members.add(user_id)
+        if user_id not in self.members:
+            self.members.add(user_id)
+            self.members_changed(added=(user_id,))
         self.update_nicklist(user_id)
 
     def user_left(self, user_id):
-        self.members.discard(user_id)
+        if user_id in self.members:
+            self.members.discard(user_id)
+            self.members_changed(removed=(user_id,))
         self.update_nicklist(user_id)
 
     def update_nicklist(self, user=None):
+        """
+        Updates the nicklist entry of user, or of all members if user is
+        None. Only the nicks which differ from what the nicklist shows are
+        added, removed or moved between groups. Updating all members is done
+        in batches of NICKLIST_BATCH_SIZE, and continued on the next ticks
+        if there are more.
+        """
         if not self.channel_buffer:
             return
         if self.type not in ["channel", "group", "mpim", "private", "shared"]:
             return
         w.buffer_set(self.channel_buffer, "nicklist", "1")
-        # create nicklists for the current channel if they don't exist
-        # if they do, use the existing pointer
-        here = w.nicklist_search_group(self.channel_buffer, "", NICK_GROUP_HERE)
-        if not here:
-            here = w.nicklist_add_group(
-                self.channel_buffer,
-                "",
-                NICK_GROUP_HERE,
-                "weechat.color.nicklist_group",
-                1,
-            )
-        afk = w.nicklist_search_group(self.channel_buffer, "", NICK_GROUP_AWAY)
-        if not afk:
-            afk = w.nicklist_add_group(
-                self.channel_buffer,
-                "",
-                NICK_GROUP_AWAY,
-                "weechat.color.nicklist_group",
-                1,
-            )
 
+        if user:
+            self.sync_nick(user, self.get_nicklist_groups())
+        else:
+            if not self.nicklist_cleared:
+                # The buffer may still have nicks or groups which weren't
+                # added by sync_nick, like the old "too many users" groups
+                w.nicklist_remove_all(self.channel_buffer)
+                self.nicklist_nicks = {}
+                self.nicklist_cleared = True
+            queued = bool(self.nicklist_queue)
+            self.nicklist_queue = deque(set(self.members) | set(self.nicklist_nicks))
+            self.sync_nicklist(NICKLIST_BATCH_SIZE)
+            if self.nicklist_queue and not queued:
+                self.eventrouter.weechat_controller.nicklist_pending(self)
+
+    def get_nicklist_groups(self):
+        """
+        Returns the pointers of the nicklist groups by name, creating the
+        groups if they don't exist.
+        """
+        groups = {}
+        group_names = [(NICK_GROUP_HERE, 1), (NICK_GROUP_AWAY, 1)]
         # Add External nicklist group only for shared channels
         if self.type == "shared":
-            external = w.nicklist_search_group(
-                self.channel_buffer, "", NICK_GROUP_EXTERNAL
+            group_names.append((NICK_GROUP_EXTERNAL, 2))
+        for name, visible in group_names:
+            groups[name] = w.nicklist_search_group(
+                self.channel_buffer, "", name
+            ) or w.nicklist_add_group(
+                self.channel_buffer, "", name, "weechat.color.nicklist_group", visible
             )
-            if not external:
-                external = w.nicklist_add_group(
-                    self.channel_buffer,
-                    "",
-                    NICK_GROUP_EXTERNAL,
-                    "weechat.color.nicklist_group",
-                    2,
-                )
-
-        if user and len(self.members) < 1000:
-            user = self.team.users.get(user)
-            # External users that have left shared channels won't exist
-            if not user or user.deleted:
-                return
-            nick = w.nicklist_search_nick(self.channel_buffer, "", user.name)
-            # since this is a change just remove it regardless of where it is
-            w.nicklist_remove_nick(self.channel_buffer, nick)
-            # now add it back in to whichever..
-            nick_group = afk
-            if user.is_external:
-                nick_group = external
-            elif self.team.is_user_present(user.identifier):
-                nick_group = here
-            if user.identifier in self.members:
-                w.nicklist_add_nick(
-                    self.channel_buffer,
-                    nick_group,
-                    user.name,
-                    user.color_name,
-                    "",
-                    "",
-                    1,
-                )
+        return groups
 
-        # if we didn't get a user, build a complete list. this is expensive.
+    def sync_nicklist(self, limit):
+        """
+        Updates the nicklist for up to limit of the queued users. Returns the
+        number of users which were updated.
+        """
+        if not self.channel_buffer:
+            self.nicklist_queue = deque()
+            return 0
+        groups = self.get_nicklist_groups()
+        count = 0
+        while self.nicklist_queue and count < limit:
+            self.sync_nick(self.nicklist_queue.popleft(), groups)
+            count += 1
+        return count
+
+    def nicklist_entry(self, user_id):
+        """
+        Returns the name, color and group a user should have in the
+        nicklist, or None if the user shouldn't be in it.
+        """
+        if user_id not in self.members:
+            return None
+        user = self.team.users.get(user_id)
+        # External users that have left shared channels won't exist
+        if not user or user.deleted:
+            return None
+        if user.is_external and self.type == "shared":
+            group = NICK_GROUP_EXTERNAL
+        elif self.team.is_user_present(user.identifier):
+            group = NICK_GROUP_HERE
         else:
-            if len(self.members) < 1000:
-                try:
-                    for user in self.members:
-                        user = self.team.users.get(user)
-                        if user.deleted:
-                            continue
-                        nick_group = afk
-                        if user.is_external:
-                            nick_group = external
-                        elif self.team.is_user_present(user.identifier):
-                            nick_group = here
-                        w.nicklist_add_nick(
-                            self.channel_buffer,
-                            nick_group,
-                            user.name,
-                            user.color_name,
-                            "",
-                            "",
-                            1,
-                        )
-                except:
-                    dbg(
-                        "DEBUG: {} {} {}".format(
-                            self.identifier, self.name, format_exc_only()
-                        )
-                    )
-            else:
-                w.nicklist_remove_all(self.channel_buffer)
-                for fn in ["1| too", "2| many", "3| users", "4| to", "5| show"]:
-                    w.nicklist_add_group(
-                        self.channel_buffer, "", fn, w.color("white"), 1
-                    )
+            group = NICK_GROUP_AWAY
+        return (user.name, user.color_name, group)
+
+    def sync_nick(self, user_id, groups):
+        entry = self.nicklist_entry(user_id)
+        shown = self.nicklist_nicks.get(user_id)
+        if shown == entry:
+            return
+        if shown:
+            # Look the nick up instead of keeping its pointer, since weechat
+            # may have removed it, e.g. with /buffer clear
+            name, _, group = shown
+            nick = w.nicklist_search_nick(self.channel_buffer, groups[group], name)
+            if nick:
+                w.nicklist_remove_nick(self.channel_buffer, nick)
+            del self.nicklist_nicks[user_id]
+        if entry:
+            name, color, group = entry
+            w.nicklist_add_nick(
+                self.channel_buffer, groups[group], name, color, "", "", 1
+            )
+            self.nicklist_nicks[user_id] = entry
 
     def render(self, message, force=False):
         text = message.render(force)
@@ -2689,91 +4044,231 @@ class SlackChannel(SlackChannelCommon):
         return text
 
 
+class SlackChannelMessages(MappingReversible):
+    """
+    Mutable mapping of SlackTS to messages, ordered by ts like a sorted
+    OrderedDict. The keys are kept in a sorted list next to the dict, so
+    inserting a message is a binary search instead of sorting all the
+    messages, and the oldest and newest messages are at the ends of the list.
+    """
+
+    def __init__(self):
+        self._messages = {}
+        self._keys = []
+
+    def __getitem__(self, key):
+        return self._messages[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._messages:
+            # New messages are usually newer than all the others
+            if not self._keys or key > self._keys[-1]:
+                self._keys.append(key)
+            else:
+                bisect.insort(self._keys, key)
+        self._messages[key] = value
+
+    def __delitem__(self, key):
+        del self._messages[key]
+        del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def __contains__(self, key):
+        return key in self._messages
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __reversed__(self):
+        return reversed(self._keys)
+
+    def key_at(self, index):
+        return self._keys[index]
+
+
 class SlackChannelVisibleMessages(MappingReversible):
     """
     Class with a reversible mapping interface (like a read-only OrderedDict)
     which doesn't include the messages older than first_ts_to_display.
+
+    Keeps sorted lists of the ts of the messages which are shown in the
+    channel, and of the ones sent by us, which are updated as messages are
+    stored and removed. Messages older than first_ts_to_display are found
+    with a binary search, so the length and looking up the nth message are
+    O(log n). The lists are rebuilt if the channel's messages are replaced
+    or thread_messages_in_channel is changed.
     """
 
     def __init__(self, channel):
         self.channel = channel
         self.first_ts_to_display = SlackTS(0)
+        self._indexed_messages = None
+        self._indexed_thread_messages_in_channel = None
+        self._visible = []
+        self._own = []
 
     def __getitem__(self, key):
         if key < self.first_ts_to_display:
             raise KeyError(key)
         return self.channel.messages[key]
 
-    def _is_visible(self, ts):
-        if ts < self.first_ts_to_display:
-            return False
-
-        message = self.get(ts)
-        if (
+    def _is_shown_in_channel(self, message):
+        return not (
             type(message) == SlackThreadMessage
             and message.subtype != "thread_broadcast"
             and not config.thread_messages_in_channel
-        ):
-            return False
+        )
 
-        return True
+    def _is_own(self, message):
+        return message.user_identifier == self.channel.team.myidentifier
+
+    def _index(self):
+        if (
+            self._indexed_messages is not self.channel.messages
+            or self._indexed_thread_messages_in_channel
+            != config.thread_messages_in_channel
+        ):
+            self._indexed_messages = self.channel.messages
+            self._indexed_thread_messages_in_channel = config.thread_messages_in_channel
+            self._visible = []
+            self._own = []
+            for ts, message in self.channel.messages.items():
+                if self._is_shown_in_channel(message):
+                    self._visible.append(ts)
+                    if self._is_own(message):
+                        self._own.append(ts)
+        return self._visible
+
+    def _first_index(self, visible):
+        return bisect.bisect_left(visible, self.first_ts_to_display)
+
+    def message_stored(self, message):
+        self.message_removed(message.ts)
+        if self._is_shown_in_channel(message):
+            insort_unique(self._visible, message.ts)
+            if self._is_own(message):
+                insort_unique(self._own, message.ts)
+
+    def message_removed(self, ts):
+        self._index()
+        remove_sorted(self._visible, ts)
+        remove_sorted(self._own, ts)
+
+    def ts_from_index(self, index, reverse=True, own=False):
+        visible = self._index()
+        if own:
+            visible = self._own
+        first = self._first_index(visible)
+        if not 0 < index <= len(visible) - first:
+            return None
+        return visible[-index] if reverse else visible[first + index - 1]
 
     def __iter__(self):
-        for ts in self.channel.messages:
-            if self._is_visible(ts):
-                yield ts
+        visible = self._index()
+        for i in range(self._first_index(visible), len(visible)):
+            yield visible[i]
 
     def __len__(self):
-        i = 0
-        for _ in self:
-            i += 1
-        return i
+        visible = self._index()
+        return len(visible) - self._first_index(visible)
 
     def __reversed__(self):
-        for ts in reversed(self.channel.messages):
-            if self._is_visible(ts):
-                yield ts
+        visible = self._index()
+        for i in range(len(visible) - 1, self._first_index(visible) - 1, -1):
+            yield visible[i]
 
 
 class SlackChannelHashedMessages(dict):
+    """
+    Maps message timestamps to short hashes and back. The short hashes are
+    prefixes of the sha1 of the ts, at least 3 characters long and long
+    enough that no hash is a prefix of another. They are kept in a prefix
+    trie, so finding a free hash only walks the characters of the new hash.
+    Each trie node is a dict of characters to child nodes, and the node of a
+    hash has the ts under the key None.
+    """
+
     def __init__(self, channel):
         self.channel = channel
+        self.trie = {}
 
     def __missing__(self, key):
         if not isinstance(key, SlackTS):
             raise KeyError(key)
 
-        hash_len = 3
         full_hash = sha1_hex(str(key))
+        node = self.trie
+        depth = 0
+        while full_hash[depth] in node:
+            node = node[full_hash[depth]]
+            depth += 1
+            if None in node:
+                hash_len = self.rehash_colliding(full_hash[:depth], full_hash)
+                break
+        else:
+            hash_len = max(depth + 1, 3)
         short_hash = full_hash[:hash_len]
 
-        while any(x.startswith(short_hash) for x in self if isinstance(x, str)):
-            hash_len += 1
-            short_hash = full_hash[:hash_len]
-
-        if short_hash[:-1] in self:
-            ts_with_same_hash = self.pop(short_hash[:-1])
-            other_full_hash = sha1_hex(str(ts_with_same_hash))
-            other_short_hash = other_full_hash[:hash_len]
-            while short_hash == other_short_hash:
-                hash_len += 1
-                short_hash = full_hash[:hash_len]
-                other_short_hash = other_full_hash[:hash_len]
-            self[other_short_hash] = ts_with_same_hash
-            self[ts_with_same_hash] = other_short_hash
-
-            other_message = self.channel.messages.get(ts_with_same_hash)
-            if other_message:
-                self.channel.change_message(other_message.ts)
-                if other_message.thread_channel:
-                    other_message.thread_channel.rename()
-                for thread_message in other_message.submessages:
-                    self.channel.change_message(thread_message)
-
         self[short_hash] = key
         self[key] = short_hash
         return self[key]
 
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            node = self.trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[None] = value
+        super(SlackChannelHashedMessages, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if isinstance(key, str):
+            self.remove_from_trie(key)
+        super(SlackChannelHashedMessages, self).__delitem__(key)
+
+    def pop(self, key, *args):
+        if isinstance(key, str) and key in self:
+            self.remove_from_trie(key)
+        return super(SlackChannelHashedMessages, self).pop(key, *args)
+
+    def remove_from_trie(self, short_hash):
+        path = [self.trie]
+        for char in short_hash:
+            path.append(path[-1][char])
+        del path[-1][None]
+        # Prune the nodes which are now empty
+        for i in range(len(short_hash), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][short_hash[i - 1]]
+
+    def rehash_colliding(self, other_short_hash, full_hash):
+        """
+        The existing hash other_short_hash is a prefix of full_hash, so make
+        it longer until it differs from full_hash. Returns the new length,
+        which is also the length of the hash for full_hash.
+        """
+        ts_with_same_hash = self.pop(other_short_hash)
+        other_full_hash = sha1_hex(str(ts_with_same_hash))
+        hash_len = len(other_short_hash) + 1
+        while full_hash[:hash_len] == other_full_hash[:hash_len]:
+            hash_len += 1
+        other_short_hash = other_full_hash[:hash_len]
+        self[other_short_hash] = ts_with_same_hash
+        self[ts_with_same_hash] = other_short_hash
+
+        other_message = self.channel.messages.get(ts_with_same_hash)
+        if other_message:
+            self.channel.change_message(other_message.ts)
+            if other_message.thread_channel:
+                other_message.thread_channel.rename()
+            for thread_message in other_message.submessages:
+                self.channel.change_message(thread_message)
+
+        return hash_len
+
 
 class SlackDMChannel(SlackChannel):
     """
@@ -2863,11 +4358,19 @@ class SlackMPDMChannel(SlackChannel):
         super(SlackMPDMChannel, self).__init__(eventrouter, "mpim", **kwargs)
 
     def name_from_members(self, team_users=None, members=None, myidentifier=None):
+        return self.format_members_name(
+            team_users or self.team.users,
+            members or self.members,
+            myidentifier or self.team.myidentifier,
+        )
+
+    @staticmethod
+    def format_members_name(team_users, members, myidentifier):
         return ",".join(
             sorted(
-                getattr((team_users or self.team.users).get(user_id), "name", user_id)
-                for user_id in (members or self.members)
-                if user_id != (myidentifier or self.team.myidentifier)
+                getattr(team_users.get(user_id), "name", user_id)
+                for user_id in members
+                if user_id != myidentifier
             )
         )
 
@@ -2898,9 +4401,264 @@ class SlackMPDMChannel(SlackChannel):
                 self.eventrouter.receive(s)
 
 
-class SlackSharedChannel(SlackChannel):
-    def __init__(self, eventrouter, **kwargs):
-        super(SlackSharedChannel, self).__init__(eventrouter, "shared", **kwargs)
+class SlackSharedChannel(SlackChannel):
+    def __init__(self, eventrouter, **kwargs):
+        super(SlackSharedChannel, self).__init__(eventrouter, "shared", **kwargs)
+
+
+class SlackChannelStub(object):
+    """
+    A placeholder for a channel from rtm.start which hasn't been used yet. It
+    only keeps the json for the channel, and answers the few things needed to
+    list channels, like the name, type and members. The methods in
+    materializing_attributes create the full channel object, which replaces
+    the stub in team.channels, and forward to it. Other attributes of the full
+    channel don't exist on a stub.
+    """
+
+    # Called on stubs by code which doesn't look up the channel by id
+    materializing_attributes = frozenset(["open", "set_name"])
+
+    __slots__ = (
+        "eventrouter",
+        "channel_class",
+        "type",
+        "channel_json",
+        "args",
+        "identifier",
+        "team",
+        "channel",
+        # Set for all channels on reconnect, but a stub has no history to
+        # update, so it's just ignored
+        "history_needs_update",
+    )
+
+    def __init__(self, eventrouter, channel_class, channel_type, channel_json, *args):
+        self.channel = None
+        self.eventrouter = eventrouter
+        self.channel_class = channel_class
+        self.type = channel_type
+        self.channel_json = channel_json
+        self.args = args
+        self.identifier = channel_json["id"]
+        self.team = None
+        self.history_needs_update = False
+
+    def __repr__(self):
+        return "Stub Name:{} Identifier:{}".format(self.name, self.identifier)
+
+    def __getattribute__(self, name):
+        # Once the channel is created, a stub which is still referenced
+        # somewhere behaves exactly like it
+        channel = object.__getattribute__(self, "channel")
+        if channel is None or name in ("channel", "materialize"):
+            return object.__getattribute__(self, name)
+        return getattr(channel, name)
+
+    def __getattr__(self, name):
+        if name in SlackChannelStub.materializing_attributes:
+            return getattr(self.materialize(), name)
+        raise AttributeError(
+            "'SlackChannelStub' object has no attribute '{}'".format(name)
+        )
+
+    def __setattr__(self, name, value):
+        if name != "channel" and self.channel is not None:
+            setattr(self.channel, name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    @property
+    def slack_name(self):
+        if self.type == "im":
+            users = self.args[0]
+            user_id = self.channel_json["user"]
+            return users[user_id].name if user_id in users else user_id
+        elif self.type == "mpim" and "members" in self.channel_json:
+            users, myidentifier = self.args
+            return SlackMPDMChannel.format_members_name(
+                users, self.channel_json["members"], myidentifier
+            )
+        return self.channel_json["name"]
+
+    @property
+    def name(self):
+        if self.type == "group" or self.type == "private":
+            prepend = config.group_name_prefix
+        elif self.type == "shared":
+            prepend = config.shared_name_prefix
+        elif self.type == "im" or self.type == "mpim":
+            prepend = ""
+        else:
+            prepend = "#"
+        return prepend + self.slack_name
+
+    def formatted_name(self, style="default", typing=False, present=None):
+        if style == "long_default":
+            return "{}.{}".format(self.team.name, self.name)
+        return self.name
+
+    @property
+    def members(self):
+        if self.type == "im":
+            return {self.channel_json["user"]}
+        return set(self.channel_json.get("members", []))
+
+    @property
+    def active(self):
+        return False
+
+    @property
+    def channel_buffer(self):
+        return None
+
+    @property
+    def is_archived(self):
+        return self.channel_json.get("is_archived", False)
+
+    @property
+    def muted(self):
+        return self.identifier in self.team.muted_channels
+
+    def materialize(self):
+        if self.channel is None:
+            team = self.team
+            channel = self.channel_class(
+                self.eventrouter, *self.args, **self.channel_json
+            )
+            self.channel = channel
+            if team:
+                team.channels[channel.identifier] = channel
+                channel.set_related_server(team)
+        return self.channel
+
+    def set_related_server(self, team):
+        self.team = team
+
+    def check_should_open(self, force=False):
+        if self.is_archived:
+            return
+
+        is_open = self.channel_json.get("is_open", self.channel_json.get("is_member"))
+        if force or is_open:
+            self.materialize().check_should_open(force)
+
+    def is_someone_typing(self):
+        return False
+
+    def mark_for_refresh(self):
+        pass
+
+    def rename(self, typing=None):
+        pass
+
+    def set_topic(self, value=None):
+        if value is not None:
+            self.channel_json["topic"] = {"value": value}
+
+    def set_highlights(self):
+        pass
+
+    def update_nicklist(self, user=None):
+        pass
+
+
+class SlackTeamChannels(SlackNameIndexedDict):
+    """
+    The channels of a team, by id. Looking up a channel by id turns a stub
+    into the full channel, while iterating over the values gives the stubs
+    as they are, so listing or completing channel names doesn't create every
+    channel in the team. Code which iterates over the channels must only use
+    what SlackChannelStub provides, or look the channel up by id.
+
+    It also indexes the channels by member, and the DMs and MPDMs by their
+    set of members. Channels must call members_changed when their members
+    change.
+    """
+
+    def __init__(self):
+        super(SlackTeamChannels, self).__init__()
+        self.ids_by_member = {}
+        self.ids_by_members = {}
+
+    def __getitem__(self, key):
+        channel = dict.__getitem__(self, key)
+        if isinstance(channel, SlackChannelStub):
+            return channel.materialize()
+        return channel
+
+    def __setitem__(self, key, channel):
+        if key in self:
+            self.unindex_members(key, dict.__getitem__(self, key))
+        super(SlackTeamChannels, self).__setitem__(key, channel)
+        self.index_members(key, channel)
+
+    def __delitem__(self, key):
+        self.unindex_members(key, dict.__getitem__(self, key))
+        super(SlackTeamChannels, self).__delitem__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def peek(self, key, default=None):
+        """
+        Returns the channel, or its stub, without creating the channel.
+        """
+        return dict.get(self, key, default)
+
+    def with_member(self, user_id):
+        """
+        Returns the channels, or stubs, which the user is a member of.
+        """
+        return [
+            dict.__getitem__(self, key) for key in self.ids_by_member.get(user_id, ())
+        ]
+
+    def get_by_members(self, members):
+        """
+        Returns the DM or MPDM, or its stub, with exactly these members.
+        """
+        return dict.get(self, self.ids_by_members.get(frozenset(members)))
+
+    def members_changed(self, key, channel, added, removed):
+        if dict.get(self, key) is not channel:
+            return
+        for user_id in removed:
+            self.remove_member(key, user_id)
+        for user_id in added:
+            self.add_member(key, user_id)
+        if channel.type in ("im", "mpim"):
+            members = frozenset(channel.members)
+            self.remove_members(key, members.difference(added).union(removed))
+            self.ids_by_members[members] = key
+
+    def index_members(self, key, channel):
+        for user_id in channel.members:
+            self.add_member(key, user_id)
+        if channel.type in ("im", "mpim"):
+            self.ids_by_members[frozenset(channel.members)] = key
+
+    def unindex_members(self, key, channel):
+        for user_id in channel.members:
+            self.remove_member(key, user_id)
+        if channel.type in ("im", "mpim"):
+            self.remove_members(key, frozenset(channel.members))
+
+    def add_member(self, key, user_id):
+        self.ids_by_member.setdefault(user_id, set()).add(key)
+
+    def remove_member(self, key, user_id):
+        ids = self.ids_by_member.get(user_id)
+        if ids:
+            ids.discard(key)
+            if not ids:
+                del self.ids_by_member[user_id]
+
+    def remove_members(self, key, members):
+        if self.ids_by_members.get(members) == key:
+            del self.ids_by_members[members]
 
 
 class SlackThreadChannel(SlackChannelCommon):
@@ -2916,7 +4674,6 @@ class SlackThreadChannel(SlackChannelCommon):
         self.parent_channel = parent_channel
         self.thread_ts = thread_ts
         self.messages = SlackThreadChannelMessages(self)
-        self.channel_buffer = None
         self.type = "thread"
         self.got_history = False
         self.history_needs_update = False
@@ -3032,6 +4789,7 @@ class SlackThreadChannel(SlackChannelCommon):
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "0")
             w.prnt_date_tags(self.channel_buffer, ts.major, tags, data)
+            self.line_positions[ts] = hdata_last_line_position(self.channel_buffer)
             if no_log:
                 w.buffer_set(self.channel_buffer, "print_hooks_enabled", "1")
             if backlog or self_msg:
@@ -3141,6 +4899,9 @@ class SlackThreadChannel(SlackChannelCommon):
     def render(self, message, force=False):
         return message.render(force)
 
+    def refetch_dropped_messages(self, messages):
+        self.parent_channel.refetch_dropped_messages(messages)
+
 
 class SlackThreadChannelMessages(MappingReversible):
     """
@@ -3180,39 +4941,94 @@ class SlackThreadChannelMessages(MappingReversible):
 class SlackUser(object):
     """
     Represends an individual slack user. Also where you set their name formatting.
-    """
+
+    Only the fields we use all the time are kept, since there can be tens of
+    thousands of users in a team. The full profile is fetched with hydrate
+    when it's needed, e.g. for /whois. The nick color is looked up the first
+    time it's used.
+    """
+
+    __slots__ = (
+        "identifier",
+        "name",
+        "username",
+        "real_name",
+        "presence",
+        "deleted",
+        "is_bot",
+        "is_external",
+        "status_emoji",
+        "status_text",
+        "_profile",
+        "_color_name",
+    )
 
     def __init__(self, originating_team_id, **kwargs):
         self.identifier = kwargs["id"]
         # These attributes may be missing in the response, so we have to make
         # sure they're set
-        self.profile = {}
+        profile = kwargs.get("profile", {})
         self.presence = kwargs.get("presence", "unknown")
         self.deleted = kwargs.get("deleted", False)
+        self.is_bot = kwargs.get("is_bot", False)
         self.is_external = (
-            not kwargs.get("is_bot") and kwargs.get("team_id") != originating_team_id
+            not self.is_bot and kwargs.get("team_id") != originating_team_id
         )
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+        self.real_name = profile.get("real_name") or kwargs.get("real_name")
+        self.status_emoji = profile.get("status_emoji", "")
+        self.status_text = profile.get("status_text", "")
+        self._profile = None
 
-        self.name = nick_from_profile(self.profile, kwargs["name"])
+        self.name = nick_from_profile(profile, kwargs["name"])
         self.username = kwargs["name"]
-        self.update_color()
+        self._color_name = None
 
     def __repr__(self):
         return "Name:{} Identifier:{}".format(self.name, self.identifier)
 
+    @property
+    def hydrated(self):
+        return self._profile is not None
+
+    def hydrate(self, user_json):
+        self._profile = user_json.get("profile", {})
+        self.update_profile(user_json)
+
+    def update_profile(self, user_json):
+        """
+        Updates the fields kept from the profile. A hydrated profile is
+        replaced by the new one, so it doesn't keep stale fields.
+        """
+        profile = user_json.get("profile", {})
+        if self._profile is not None:
+            self._profile = profile
+        self.real_name = profile.get("real_name") or user_json.get("real_name")
+        self.status_emoji = profile.get("status_emoji", "")
+        self.status_text = profile.get("status_text", "")
+
+    @property
+    def profile(self):
+        if self._profile is not None:
+            return self._profile
+        return {
+            "real_name": self.real_name,
+            "status_emoji": self.status_emoji,
+            "status_text": self.status_text,
+        }
+
+    @property
+    def color_name(self):
+        if self._color_name is None:
+            # This will automatically be none/"" if the user has disabled nick
+            # colourization.
+            self._color_name = get_nick_color(self.name)
+        return self._color_name
+
     def force_color(self, color_name):
-        self.color_name = color_name
+        self._color_name = color_name
 
     def update_color(self):
-        # This will automatically be none/"" if the user has disabled nick
-        # colourization.
-        self.color_name = get_nick_color(self.name)
-
-    def update_status(self, status_emoji, status_text):
-        self.profile["status_emoji"] = status_emoji
-        self.profile["status_text"] = status_text
+        self._color_name = None
 
     def formatted_name(self, prepend="", enable_color=True):
         name = prepend + self.name
@@ -3228,6 +5044,8 @@ class SlackBot(SlackUser):
     needs
     """
 
+    __slots__ = ()
+
     def __init__(self, originating_team_id, **kwargs):
         super(SlackBot, self).__init__(originating_team_id, is_bot=True, **kwargs)
 
@@ -3241,10 +5059,27 @@ class SlackMessage(object):
     can be deleted, so we have to store sender in each one.
     """
 
+    __slots__ = (
+        "team",
+        "channel",
+        "subtype",
+        "user_identifier",
+        "message_json",
+        "submessages",
+        "ts",
+        "subscribed",
+        "last_read",
+        "last_notify",
+        "rendered_text",
+        "rendered_body",
+    )
+
     def __init__(self, subtype, message_json, channel):
         self.team = channel.team
         self.channel = channel
         self.subtype = subtype
+        if "user" in message_json:
+            message_json["user"] = intern_id(message_json["user"])
         self.user_identifier = message_json.get("user")
         self.message_json = message_json
         self.submessages = []
@@ -3252,6 +5087,9 @@ class SlackMessage(object):
         self.subscribed = message_json.get("subscribed", False)
         self.last_read = SlackTS(message_json.get("last_read", 0))
         self.last_notify = SlackTS(0)
+        self.rendered_text = None
+        # Set when the raw json has been dropped to save memory, see drop_json
+        self.rendered_body = None
 
     def __hash__(self):
         return hash(self.ts)
@@ -3275,9 +5113,38 @@ class SlackMessage(object):
 
     def render(self, force=False):
         # If we already have a rendered version in the object, just return that.
-        if not force and self.message_json.get("_rendered_text"):
-            return self.message_json["_rendered_text"]
+        if not force and self.rendered_text:
+            return self.rendered_text
+
+        if self.rendered_body is not None:
+            text = self.rendered_body
+        else:
+            text = self.render_body()
+
+        text += create_reactions_string(
+            self.message_json.get("reactions", ""), self.team.myidentifier
+        )
+
+        if self.number_of_replies():
+            text += " " + colorize_string(
+                get_thread_color(self.hash),
+                "[ Thread: {} Replies: {}{} ]".format(
+                    self.hash,
+                    self.number_of_replies(),
+                    " Subscribed" if self.subscribed else "",
+                ),
+            )
+
+        text = replace_string_with_emoji(text)
 
+        self.rendered_text = text
+        return text
+
+    def render_body(self):
+        """
+        Renders the parts of the message which need the raw json, i.e.
+        everything except the reactions and the thread info.
+        """
         blocks = self.message_json.get("blocks", [])
         blocks_rendered = "\n".join(unfurl_blocks(blocks))
         has_rich_text = any(block["type"] == "rich_text" for block in blocks)
@@ -3318,29 +5185,42 @@ class SlackMessage(object):
 
         text += unfurl_refs(unwrap_attachments(self.message_json, text))
         text += unfurl_refs(unwrap_files(self.message_json, text))
-        text = unhtmlescape(text.lstrip().replace("\t", "    "))
-
-        text += create_reactions_string(
-            self.message_json.get("reactions", ""), self.team.myidentifier
-        )
+        return unhtmlescape(text.lstrip().replace("\t", "    "))
 
-        if self.number_of_replies():
-            text += " " + colorize_string(
-                get_thread_color(self.hash),
-                "[ Thread: {} Replies: {}{} ]".format(
-                    self.hash,
-                    self.number_of_replies(),
-                    " Subscribed" if self.subscribed else "",
-                ),
-            )
+    def drop_json(self):
+        """
+        Replaces the raw json with only the fields needed to update the
+        message, and keeps the rendered body instead. The body is rendered
+        again when the message changes, or when /rehistory has fetched the
+        json again (see refetch_dropped_messages).
+        """
+        if self.rendered_body is not None:
+            return
+        self.rendered_body = self.render_body()
+        self.message_json = {
+            key: self.message_json[key]
+            for key in SLIM_MESSAGE_KEYS
+            if key in self.message_json
+        }
+        for key in ("team", "user_team"):
+            if key in self.message_json:
+                self.message_json[key] = intern_id(self.message_json[key])
 
-        text = replace_string_with_emoji(text)
+    def replace_json(self, message_json):
+        if "user" in message_json:
+            message_json["user"] = intern_id(message_json["user"])
+        self.message_json = message_json
+        self.rendered_body = None
 
-        self.message_json["_rendered_text"] = text
-        return text
+    def update_json(self, message_json):
+        self.message_json.update(message_json)
+        if "text" in message_json:
+            # The whole message was sent again, so render it from the json
+            self.rendered_body = None
 
     def change_text(self, new_text):
         self.message_json["text"] = new_text
+        self.rendered_body = None
         dbg(self.message_json)
 
     def get_sender(self, plain):
@@ -3461,6 +5341,8 @@ class SlackMessage(object):
 
 
 class SlackThreadMessage(SlackMessage):
+    __slots__ = ("parent_channel", "thread_ts")
+
     def __init__(self, parent_channel, thread_ts, message_json, *args):
         subtype = message_json.get(
             "subtype",
@@ -3486,58 +5368,68 @@ class Hdata(object):
 
 
 class SlackTS(object):
+    """
+    A Slack timestamp, like 1234567890.123456. The major (seconds) and minor
+    parts are packed into one integer, so comparing and hashing them is
+    cheap. They can still be compared with strings in the same format.
+    """
+
+    __slots__ = ("value",)
+
     def __init__(self, ts=None):
-        if isinstance(ts, int):
-            self.major = ts
-            self.minor = 0
+        if isinstance(ts, SlackTS):
+            self.value = ts.value
+        elif isinstance(ts, int):
+            self.value = ts * SLACK_TS_MINOR_UNITS
         elif ts is not None:
-            self.major, self.minor = [int(x) for x in ts.split(".", 1)]
+            major, minor = [int(x) for x in ts.split(".", 1)]
+            self.value = major * SLACK_TS_MINOR_UNITS + minor
         else:
-            self.major = int(time.time())
-            self.minor = 0
-
-    def __cmp__(self, other):
-        if isinstance(other, SlackTS):
-            if self.major < other.major:
-                return -1
-            elif self.major > other.major:
-                return 1
-            elif self.major == other.major:
-                if self.minor < other.minor:
-                    return -1
-                elif self.minor > other.minor:
-                    return 1
-                else:
-                    return 0
-        elif isinstance(other, str):
-            s = self.__str__()
-            if s < other:
-                return -1
-            elif s > other:
-                return 1
-            elif s == other:
-                return 0
+            self.value = int(time.time()) * SLACK_TS_MINOR_UNITS
+
+    @property
+    def major(self):
+        return self.value // SLACK_TS_MINOR_UNITS
+
+    @property
+    def minor(self):
+        return self.value % SLACK_TS_MINOR_UNITS
+
+    def _cmp_str(self, other):
+        if isinstance(other, str):
+            s = self.__repr__()
+            return (s > other) - (s < other)
 
     def __lt__(self, other):
-        return self.__cmp__(other) < 0
+        if type(other) is SlackTS:
+            return self.value < other.value
+        return self._cmp_str(other) < 0
 
     def __le__(self, other):
-        return self.__cmp__(other) <= 0
+        if type(other) is SlackTS:
+            return self.value <= other.value
+        return self._cmp_str(other) <= 0
 
     def __eq__(self, other):
-        return self.__cmp__(other) == 0
+        if type(other) is SlackTS:
+            return self.value == other.value
+        return self._cmp_str(other) == 0
 
     def __ne__(self, other):
-        return self.__cmp__(other) != 0
+        return not self.__eq__(other)
 
     def __ge__(self, other):
-        return self.__cmp__(other) >= 0
+        if type(other) is SlackTS:
+            return self.value >= other.value
+        return self._cmp_str(other) >= 0
 
     def __gt__(self, other):
-        return self.__cmp__(other) > 0
+        if type(other) is SlackTS:
+            return self.value > other.value
+        return self._cmp_str(other) > 0
 
     def __hash__(self):
-        return hash("{}.{}".format(self.major, self.minor))
+        return hash(self.value)
 
     def __repr__(self):
         return str("{0}.{1:06d}".format(self.major, self.minor))
@@ -3555,6 +5447,38 @@ class SlackTS(object):
 ###### New handlers
 
 
+def decode_rtm_start(body):
+    """
+    Decodes the rtm.start reply and builds the team model from it. This runs
+    in the background worker, so it must not call the weechat API.
+    """
+    login_data = json.loads(body)
+    team_model = build_team_model(login_data) if login_data["ok"] else None
+    return login_data, team_model
+
+
+def build_team_model(login_data):
+    """
+    Builds the users, bots and subteams of a team from the rtm.start reply.
+    """
+    team_id = login_data["team"]["id"]
+
+    users = SlackNameIndexedDict()
+    for item in login_data["users"]:
+        users[item["id"]] = SlackUser(team_id, **item)
+
+    bots = {}
+    for item in login_data["bots"]:
+        bots[item["id"]] = SlackBot(team_id, **item)
+
+    subteams = SlackNameIndexedDict("handle")
+    for item in login_data["subteams"]["all"]:
+        is_member = item["id"] in login_data["subteams"]["self"]
+        subteams[item["id"]] = SlackSubteam(team_id, is_member=is_member, **item)
+
+    return {"users": users, "bots": bots, "subteams": subteams}
+
+
 def handle_rtmstart(login_data, eventrouter, team, channel, metadata):
     """
     This handles the main entry call to slack, rtm.start
@@ -3589,46 +5513,61 @@ def handle_rtmstart(login_data, eventrouter, team, channel, metadata):
         login_data["team"]["id"], login_data["team"]["domain"]
     )
     if not eventrouter.teams.get(th):
-
-        users = {}
-        for item in login_data["users"]:
-            users[item["id"]] = SlackUser(login_data["team"]["id"], **item)
-
-        bots = {}
-        for item in login_data["bots"]:
-            bots[item["id"]] = SlackBot(login_data["team"]["id"], **item)
-
-        subteams = {}
-        for item in login_data["subteams"]["all"]:
-            is_member = item["id"] in login_data["subteams"]["self"]
-            subteams[item["id"]] = SlackSubteam(
-                login_data["team"]["id"], is_member=is_member, **item
-            )
-
-        channels = {}
+        # The team model is usually built in the background worker when
+        # the reply is decoded, but build it here if it wasn't
+        team_model = metadata.metadata.pop("team_model", None)
+        if not team_model:
+            team_model = build_team_model(login_data)
+        users = team_model["users"]
+        bots = team_model["bots"]
+        subteams = team_model["subteams"]
+
+        # Only stubs are created here, and a channel is created when it's
+        # first used, so teams with many channels connect faster
+        channels = SlackTeamChannels()
         for item in login_data["channels"]:
             if item["is_shared"]:
-                channels[item["id"]] = SlackSharedChannel(eventrouter, **item)
+                channels[item["id"]] = SlackChannelStub(
+                    eventrouter, SlackSharedChannel, "shared", item
+                )
             elif item["is_mpim"]:
-                channels[item["id"]] = SlackMPDMChannel(
-                    eventrouter, users, login_data["self"]["id"], **item
+                channels[item["id"]] = SlackChannelStub(
+                    eventrouter,
+                    SlackMPDMChannel,
+                    "mpim",
+                    item,
+                    users,
+                    login_data["self"]["id"],
                 )
             elif item["is_private"]:
-                channels[item["id"]] = SlackPrivateChannel(eventrouter, **item)
+                channels[item["id"]] = SlackChannelStub(
+                    eventrouter, SlackPrivateChannel, "private", item
+                )
             else:
-                channels[item["id"]] = SlackChannel(eventrouter, **item)
+                channels[item["id"]] = SlackChannelStub(
+                    eventrouter, SlackChannel, "channel", item
+                )
 
         for item in login_data["ims"]:
-            channels[item["id"]] = SlackDMChannel(eventrouter, users, **item)
+            channels[item["id"]] = SlackChannelStub(
+                eventrouter, SlackDMChannel, "im", item, users
+            )
 
         for item in login_data["mpims"]:
-            channels[item["id"]] = SlackMPDMChannel(
-                eventrouter, users, login_data["self"]["id"], **item
+            channels[item["id"]] = SlackChannelStub(
+                eventrouter,
+                SlackMPDMChannel,
+                "mpim",
+                item,
+                users,
+                login_data["self"]["id"],
             )
 
         for item in login_data["groups"]:
             if not item["is_mpim"]:
-                channels[item["id"]] = SlackGroupChannel(eventrouter, **item)
+                channels[item["id"]] = SlackChannelStub(
+                    eventrouter, SlackGroupChannel, "group", item
+                )
 
         t = SlackTeam(
             eventrouter,
@@ -3702,7 +5641,7 @@ def handle_rtmconnect(login_data, eventrouter, team, channel, metadata):
 
 def handle_emojilist(emoji_json, eventrouter, team, channel, metadata):
     if emoji_json["ok"]:
-        team.emoji_completions.extend(emoji_json["emoji"].keys())
+        team.set_custom_emoji(list(emoji_json["emoji"].keys()))
 
 
 def handle_channelsinfo(channel_json, eventrouter, team, channel, metadata):
@@ -3739,6 +5678,8 @@ def handle_mpimopen(
 def handle_history(
     message_json, eventrouter, team, channel, metadata, includes_threads=True
 ):
+    if "refetch" in metadata:
+        return handle_refetched_messages(message_json, channel, metadata)
     channel.got_history = True
     channel.history_needs_update = False
     for message in reversed(message_json["messages"]):
@@ -3785,7 +5726,24 @@ def handle_conversationshistory(
     handle_history(message_json, eventrouter, team, channel, metadata, False)
 
 
+def handle_refetched_messages(message_json, channel, metadata):
+    """
+    Updates the messages fetched again by refetch_dropped_messages. Their
+    json is dropped again by change_message after it's rendered.
+    """
+    for message in message_json["messages"]:
+        m = channel.messages.get(SlackTS(message["ts"]))
+        if m and m.rendered_body is not None:
+            m.replace_json(message)
+            channel.change_message(m.ts)
+    next_cursor = message_json.get("response_metadata", {}).get("next_cursor")
+    if next_cursor:
+        channel.request_refetch(*metadata["refetch"], cursor=next_cursor)
+
+
 def handle_conversationsreplies(message_json, eventrouter, team, channel, metadata):
+    if "refetch" in metadata:
+        return handle_refetched_messages(message_json, channel, metadata)
     for message in message_json["messages"]:
         process_message(
             message, eventrouter, team, channel, metadata, history_message=True
@@ -3804,10 +5762,7 @@ def handle_conversationsmembers(members_json, eventrouter, team, channel, metada
     if members_json["ok"]:
         channel.got_members = True
         channel.set_members(members_json["members"])
-        unknown_users = set(members_json["members"]) - set(team.users.keys())
-        for user in unknown_users:
-            s = SlackRequest(team, "users.info", {"user": user}, channel=channel)
-            eventrouter.receive(s)
+        team.user_resolver.resolve(members_json["members"], channel)
         if channel.type == "mpim":
             name = channel.name_from_members()
             channel.set_name(name)
@@ -3821,18 +5776,42 @@ def handle_conversationsmembers(members_json, eventrouter, team, channel, metada
 
 
 def handle_usersinfo(user_json, eventrouter, team, channel, metadata):
+    if "batch" in metadata:
+        team.user_resolver.user_received(metadata["batch"])
+    if not user_json["ok"]:
+        dbg("Couldn't get user info: {}".format(user_json["error"]), level=4)
+        return
+
     user_info = user_json["user"]
-    if not metadata.get("user"):
+    user = metadata.get("user")
+    if not user:
         user = SlackUser(team.identifier, **user_info)
         team.users[user_info["id"]] = user
 
-    if channel.type == "shared":
+    if "whois" in metadata:
+        user.hydrate(user_info)
+        print_user_info(team, metadata["whois"], user)
+    elif not channel:
+        return
+    elif channel.type == "shared":
         channel.update_nicklist(user_info["id"])
     elif channel.type == "im":
         channel.set_name(user.name)
         channel.set_topic(create_user_status_string(user.profile))
 
 
+def handle_userslist(users_json, eventrouter, team, channel, metadata):
+    if users_json["ok"]:
+        for user_info in users_json["members"]:
+            if user_info["id"] not in team.users:
+                team.users[user_info["id"]] = SlackUser(team.identifier, **user_info)
+        next_cursor = users_json.get("response_metadata", {}).get("next_cursor")
+        team.user_resolver.users_list_received(metadata["batch"], next_cursor)
+    else:
+        dbg("Couldn't get user list: {}".format(users_json["error"]), level=4)
+        team.user_resolver.users_list_failed(metadata["batch"])
+
+
 def handle_usergroupsuserslist(users_json, eventrouter, team, channel, metadata):
     header = "Users in {}".format(metadata["usergroup_handle"])
     users = [team.users[key] for key in users_json["users"]]
@@ -3973,14 +5952,21 @@ def process_pref_change(message_json, eventrouter, team, channel, metadata):
 
 def process_user_change(message_json, eventrouter, team, channel, metadata):
     """
-    Currently only used to update status, but lots here we could do.
+    Currently only used to update the name and status, but lots here we could do.
     """
     user = metadata["user"]
     profile = message_json["user"]["profile"]
     if user:
-        user.update_status(profile.get("status_emoji"), profile.get("status_text"))
+        old_name = user.name
+        user.name = nick_from_profile(profile, message_json["user"]["name"])
+        if user.name != old_name:
+            user.update_color()
+            team.users.name_changed(user.identifier, user)
+        user.update_profile(message_json["user"])
         dmchannel = team.find_channel_by_members({user.identifier}, channel_type="im")
         if dmchannel:
+            if user.name != old_name:
+                dmchannel.set_name(user.name)
             dmchannel.set_topic(create_user_status_string(profile))
 
 
@@ -4091,9 +6077,8 @@ def subprocess_thread_message(
     message = SlackThreadMessage(channel, parent_ts, message_json, channel)
 
     parent_message = message.parent_message
-    if parent_message and message.ts not in parent_message.submessages:
-        parent_message.submessages.append(message.ts)
-        parent_message.submessages.sort()
+    if parent_message:
+        insort_unique(parent_message.submessages, message.ts)
 
     channel.store_message(message)
 
@@ -4355,22 +6340,22 @@ def process_thread_unsubscribed(message_json, eventrouter, team, channel, metada
 
 ###### New module/global methods
 def render_formatting(text):
-    text = re.sub(
-        r"(^| )\*([^*\n`]+)\*(?=[^\w]|$)",
-        r"\1{}*\2*{}".format(
-            w.color(config.render_bold_as), w.color("-" + config.render_bold_as)
-        ),
-        text,
-        flags=re.UNICODE,
-    )
-    text = re.sub(
-        r"(^| )_([^_\n`]+)_(?=[^\w]|$)",
-        r"\1{}_\2_{}".format(
-            w.color(config.render_italic_as), w.color("-" + config.render_italic_as)
-        ),
-        text,
-        flags=re.UNICODE,
-    )
+    if "*" in text:
+        text = BOLD_REGEX.sub(
+            r"\1{}*\2*{}".format(
+                get_color(config.render_bold_as),
+                get_color("-" + config.render_bold_as),
+            ),
+            text,
+        )
+    if "_" in text:
+        text = ITALIC_REGEX.sub(
+            r"\1{}_\2_{}".format(
+                get_color(config.render_italic_as),
+                get_color("-" + config.render_italic_as),
+            ),
+            text,
+        )
     return text
 
 
@@ -4487,7 +6472,8 @@ def unfurl_refs(text):
     #  - <#C2147483705|#otherchannel>
     #  - <@U2147483697|@othernick>
     #  - <!subteam^U2147483697|@group>
-    # Test patterns lives in ./_pytest/test_unfurl.py
+    if "<" not in text:
+        return text
 
     def unfurl_ref(match):
         ref, fallback = match.groups()
@@ -4507,8 +6493,7 @@ def unfurl_refs(text):
             elif ref.startswith("!date"):
                 return fallback
             else:
-                match_url = r"^\w+:(//)?{}$".format(re.escape(fallback))
-                url_matches_desc = re.match(match_url, ref)
+                url_matches_desc = url_matches_description(ref, fallback)
                 if url_matches_desc and config.unfurl_auto_link_display == "text":
                     return fallback
                 elif url_matches_desc and config.unfurl_auto_link_display == "url":
@@ -4517,10 +6502,24 @@ def unfurl_refs(text):
                     return "{} ({})".format(ref, fallback)
         return ref
 
-    return re.sub(r"<([^|>]*)(?:\|([^>]*))?>", unfurl_ref, text)
+    return REF_REGEX.sub(unfurl_ref, text)
+
+
+def url_matches_description(url, description):
+    """
+    Checks if the description of a link is the url itself, with or without
+    the scheme, e.g. <https://example.com|example.com>.
+    """
+    match = URL_SCHEME_REGEX.match(url)
+    if not match:
+        return False
+    rest = url[match.end() :]
+    return rest == description or rest == "//" + description
 
 
 def unhtmlescape(text):
+    if "&" not in text:
+        return text
     return text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
 
 
@@ -4678,9 +6677,38 @@ def unwrap_files(message_json, text_before):
     return "\n".join(files_texts)
 
 
+def invalidate_resolved_refs():
+    """
+    Marks the resolved references as stale, so they are cleared on the next
+    lookup. This is cheap enough to call for every user or channel added, and
+    only the main thread touches RESOLVED_REFS, even when users are added in
+    the background worker.
+    """
+    global RESOLVED_REFS_STALE
+    RESOLVED_REFS_STALE = True
+
+
 def resolve_ref(ref):
+    global RESOLVED_REFS_STALE
     if ref in ["!channel", "!everyone", "!group", "!here"]:
         return ref.replace("!", "@")
+    elif ref.startswith("!date"):
+        return resolve_date_ref(ref)
+    elif ref.startswith("@") or ref.startswith("#") or ref.startswith("!subteam"):
+        if RESOLVED_REFS_STALE:
+            RESOLVED_REFS.clear()
+            RESOLVED_REFS_STALE = False
+        resolved_ref = RESOLVED_REFS.get(ref)
+        if resolved_ref is None:
+            resolved_ref = resolve_team_ref(ref)
+            RESOLVED_REFS[ref] = resolved_ref
+        return resolved_ref
+
+    # Something else, just return as-is
+    return ref
+
+
+def resolve_team_ref(ref):
     for team in EVENTROUTER.teams.values():
         if ref.startswith("@"):
             user = team.users.get(ref[1:])
@@ -4688,7 +6716,7 @@ def resolve_ref(ref):
                 suffix = config.external_user_suffix if user.is_external else ""
                 return "@{}{}".format(user.name, suffix)
         elif ref.startswith("#"):
-            channel = team.channels.get(ref[1:])
+            channel = team.channels.peek(ref[1:])
             if channel:
                 return channel.name
         elif ref.startswith("!subteam"):
@@ -4696,41 +6724,40 @@ def resolve_ref(ref):
             subteam = team.subteams.get(subteam_id)
             if subteam:
                 return subteam.handle
-        elif ref.startswith("!date"):
-            parts = ref.split("^")
-            ref_datetime = datetime.fromtimestamp(int(parts[1]))
-            link_suffix = " ({})".format(parts[3]) if len(parts) > 3 else ""
-            token_to_format = {
-                "date_num": "%Y-%m-%d",
-                "date": "%B %d, %Y",
-                "date_short": "%b %d, %Y",
-                "date_long": "%A, %B %d, %Y",
-                "time": "%H:%M",
-                "time_secs": "%H:%M:%S",
-            }
+    return ref
 
-            def replace_token(match):
-                token = match.group(1)
-                if token.startswith("date_") and token.endswith("_pretty"):
-                    if ref_datetime.date() == date.today():
-                        return "today"
-                    elif ref_datetime.date() == date.today() - timedelta(days=1):
-                        return "yesterday"
-                    elif ref_datetime.date() == date.today() + timedelta(days=1):
-                        return "tomorrow"
-                    else:
-                        token = token.replace("_pretty", "")
-                if token in token_to_format:
-                    return decode_from_utf8(
-                        ref_datetime.strftime(token_to_format[token])
-                    )
-                else:
-                    return match.group(0)
 
-            return re.sub(r"{([^}]+)}", replace_token, parts[2]) + link_suffix
+def resolve_date_ref(ref):
+    today = date.today()
+    resolved_day, resolved_ref = RESOLVED_DATE_REFS.get(ref, (None, None))
+    if resolved_day == today:
+        return resolved_ref
+
+    parts = ref.split("^")
+    ref_datetime = datetime.fromtimestamp(int(parts[1]))
+    link_suffix = " ({})".format(parts[3]) if len(parts) > 3 else ""
+
+    def replace_token(match):
+        token = match.group(1)
+        if token.startswith("date_") and token.endswith("_pretty"):
+            if ref_datetime.date() == today:
+                return "today"
+            elif ref_datetime.date() == today - timedelta(days=1):
+                return "yesterday"
+            elif ref_datetime.date() == today + timedelta(days=1):
+                return "tomorrow"
+            else:
+                token = token.replace("_pretty", "")
+        if token in DATE_REF_FORMATS:
+            return decode_from_utf8(ref_datetime.strftime(DATE_REF_FORMATS[token]))
+        else:
+            return match.group(0)
 
-    # Something else, just return as-is
-    return ref
+    resolved_ref = re.sub(r"{([^}]+)}", replace_token, parts[2]) + link_suffix
+    if len(RESOLVED_DATE_REFS) >= RESOLVED_DATE_REFS_MAX:
+        RESOLVED_DATE_REFS.clear()
+    RESOLVED_DATE_REFS[ref] = (today, resolved_ref)
+    return resolved_ref
 
 
 def create_user_status_string(profile):
@@ -4782,15 +6809,55 @@ def hdata_line_ts(line_pointer):
     return None
 
 
-def modify_buffer_line(buffer_pointer, ts, new_text):
+def hdata_last_line_position(buffer_pointer):
     own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
-    line_pointer = w.hdata_pointer(hdata.lines, own_lines, "last_line")
+    return (
+        w.hdata_pointer(hdata.lines, own_lines, "last_line"),
+        w.hdata_integer(hdata.lines, own_lines, "lines_count"),
+    )
 
-    # Find the last line with this ts
-    is_last_line = True
-    while line_pointer and hdata_line_ts(line_pointer) != ts:
-        is_last_line = False
-        line_pointer = w.hdata_move(hdata.line, line_pointer, -1)
+
+def modify_buffer_line(buffer_pointer, ts, new_text, line_positions=None):
+    """
+    Replaces the text in the lines of the message with ts. line_positions
+    maps the ts of the printed messages to the pointer and position of their
+    last line, as returned by hdata_last_line_position after printing them.
+    It's used to find the lines without searching the buffer, and updated
+    when they have to be searched for.
+    """
+    if line_positions is None:
+        line_positions = {}
+    own_lines = w.hdata_pointer(hdata.buffer, buffer_pointer, "own_lines")
+    last_line = w.hdata_pointer(hdata.lines, own_lines, "last_line")
+    lines_count = w.hdata_integer(hdata.lines, own_lines, "lines_count")
+
+    # The line is still at the same position if no lines have been removed
+    # from the start of the buffer since it was printed. Stored pointers are
+    # only compared, never used, as the line may have been freed.
+    line_pointer = None
+    if ts in line_positions:
+        pointer, position = line_positions[ts]
+        if 0 < position < lines_count:
+            moved_pointer = w.hdata_move(hdata.line, last_line, position - lines_count)
+        else:
+            moved_pointer = last_line if position == lines_count else None
+        if moved_pointer == pointer and hdata_line_ts(pointer) == ts:
+            line_pointer = pointer
+    is_last_line = line_pointer == last_line
+
+    if not line_pointer:
+        # Find the last line with this ts
+        line_pointer = last_line
+        is_last_line = True
+        position = lines_count
+        while line_pointer and hdata_line_ts(line_pointer) != ts:
+            is_last_line = False
+            position -= 1
+            line_pointer = w.hdata_move(hdata.line, line_pointer, -1)
+        if line_pointer:
+            line_positions[ts] = (line_pointer, position)
+        else:
+            line_positions.pop(ts, None)
 
     # Find all lines for the message
     pointers = []
@@ -4822,6 +6889,7 @@ def modify_buffer_line(buffer_pointer, ts, new_text):
             for _ in range(extra_lines_count):
                 w.prnt_date_tags(buffer_pointer, ts.major, tags_str, " \t ")
                 pointers.append(w.hdata_pointer(hdata.lines, own_lines, "last_line"))
+            line_positions[ts] = hdata_last_line_position(buffer_pointer)
             if should_set_unread:
                 w.buffer_set(buffer_pointer, "unread", "")
             w.buffer_set(buffer_pointer, "print_hooks_enabled", "1")
@@ -5044,6 +7112,27 @@ def topic_command_cb(data, current_buffer, command):
     return w.WEECHAT_RC_OK_EAT
 
 
+def print_user_info(team, nick, user):
+    def print_profile(field):
+        value = user.profile.get(field)
+        if value:
+            team.buffer_prnt("[{}]: {}: {}".format(nick, field, value))
+
+    team.buffer_prnt("[{}]: {}".format(nick, user.real_name))
+    status_emoji = replace_string_with_emoji(user.profile.get("status_emoji", ""))
+    status_text = user.profile.get("status_text", "")
+    if status_emoji or status_text:
+        team.buffer_prnt("[{}]: {} {}".format(nick, status_emoji, status_text))
+
+    team.buffer_prnt("[{}]: username: {}".format(nick, user.username))
+    team.buffer_prnt("[{}]: id: {}".format(nick, user.identifier))
+
+    print_profile("title")
+    print_profile("email")
+    print_profile("phone")
+    print_profile("skype")
+
+
 @slack_buffer_or_ignore
 @utf8_decode
 def whois_command_cb(data, current_buffer, command):
@@ -5061,25 +7150,13 @@ def whois_command_cb(data, current_buffer, command):
     team = EVENTROUTER.weechat_controller.buffers[current_buffer].team
     u = team.users.get(team.get_username_map().get(user))
     if u:
-
-        def print_profile(field):
-            value = u.profile.get(field)
-            if value:
-                team.buffer_prnt("[{}]: {}: {}".format(user, field, value))
-
-        team.buffer_prnt("[{}]: {}".format(user, u.real_name))
-        status_emoji = replace_string_with_emoji(u.profile.get("status_emoji", ""))
-        status_text = u.profile.get("status_text", "")
-        if status_emoji or status_text:
-            team.buffer_prnt("[{}]: {} {}".format(user, status_emoji, status_text))
-
-        team.buffer_prnt("[{}]: username: {}".format(user, u.username))
-        team.buffer_prnt("[{}]: id: {}".format(user, u.identifier))
-
-        print_profile("title")
-        print_profile("email")
-        print_profile("phone")
-        print_profile("skype")
+        if u.hydrated:
+            print_user_info(team, user, u)
+        else:
+            s = SlackRequest(
+                team, "users.info", {"user": u.identifier}, metadata={"whois": user}
+            )
+            EVENTROUTER.receive(s)
     else:
         team.buffer_prnt("[{}]: No such user".format(user))
     return w.WEECHAT_RC_OK_EAT
@@ -5306,6 +7383,60 @@ def command_users(data, current_buffer, args):
     return print_users_info(team, "Users", team.users.values())
 
 
+@utf8_decode
+def command_queue(data, current_buffer, args):
+    """
+    /slack queue
+    Show the number of queued events and how fast they are being processed.
+    """
+    e = EVENTROUTER
+    w.prnt("", "Slack event queue:")
+    w.prnt(
+        "",
+        "    queued: {}, max queued: {}".format(len(e.queue), e.queue_depth_max),
+    )
+    w.prnt(
+        "",
+        "    processed: {}, last tick: {}, rate: {:.1f}/s, budget: {} ms".format(
+            e.events_processed,
+            e.events_processed_last_tick,
+            e.drain_rate,
+            config.event_drain_budget,
+        ),
+    )
+    scheduler = e.request_scheduler
+    w.prnt(
+        "",
+        "    pending requests: {} (background: {}), rate limited: {}".format(
+            len(scheduler),
+            scheduler.pending_count(REQUEST_PRIORITY_BACKGROUND),
+            scheduler.rate_limited_count,
+        ),
+    )
+    w.prnt(
+        "",
+        "    in flight: {}, coalesced: {}".format(
+            len(e.inflight_requests), e.coalesced_count
+        ),
+    )
+    if e.replies_received:
+        w.prnt(
+            "",
+            "    replies: {}, average size: {} chars in {:.1f} fragments".format(
+                e.replies_received,
+                e.reply_size_total // e.replies_received,
+                e.reply_fragments_total / float(e.replies_received),
+            ),
+        )
+        w.prnt(
+            "",
+            "    largest reply: {} ({} chars in {} fragments)".format(*e.largest_reply),
+        )
+    for method, blocked_for in sorted(scheduler.blocked_methods()):
+        w.prnt("", "    {} blocked for {:.0f}s".format(method, blocked_for))
+    return w.WEECHAT_RC_OK_EAT
+
+
 @slack_buffer_required
 @utf8_decode
 def command_usergroups(data, current_buffer, args):
@@ -6087,20 +8218,63 @@ def create_slack_debug_buffer():
         w.buffer_set(slack_debug, "highlight_tags_restrict", "highlight_force")
 
 
+def get_cache_path(name):
+    cache_dir = w.info_get("weechat_cache_dir", "") or w.info_get("weechat_dir", "")
+    return "{}/{}_{}.cache".format(cache_dir, SCRIPT_NAME, name)
+
+
+def read_cache(name):
+    """
+    Reads data written with write_cache, or returns None if there is no
+    cache or it can't be read, e.g. because it was written by another
+    python version.
+    """
+    try:
+        with open(get_cache_path(name), "rb") as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(name, data):
+    """
+    Stores data which is expensive to build or fetch in weechat's cache
+    directory. It's written with marshal, so it can only contain builtin
+    types.
+    """
+    path = get_cache_path(name)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            marshal.dump(data, f)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError, ValueError):
+        dbg("Couldn't write cache {}: {}".format(path, format_exc_only()), 5)
+
+
+def get_weemoji_path():
+    weechat_dir = w.info_get("weechat_data_dir", "") or w.info_get("weechat_dir", "")
+    weechat_sharedir = w.info_get("weechat_sharedir", "")
+    local_weemoji, global_weemoji = (
+        "{}/weemoji.json".format(path) for path in (weechat_dir, weechat_sharedir)
+    )
+    return (
+        global_weemoji
+        if os.path.exists(global_weemoji) and not os.path.exists(local_weemoji)
+        else local_weemoji
+    )
+
+
 def load_emoji():
     try:
-        weechat_dir = w.info_get("weechat_data_dir", "") or w.info_get(
-            "weechat_dir", ""
-        )
-        weechat_sharedir = w.info_get("weechat_sharedir", "")
-        local_weemoji, global_weemoji = (
-            "{}/weemoji.json".format(path) for path in (weechat_dir, weechat_sharedir)
-        )
-        path = (
-            global_weemoji
-            if os.path.exists(global_weemoji) and not os.path.exists(local_weemoji)
-            else local_weemoji
-        )
+        path = get_weemoji_path()
+        # The parsed tables are cached until weemoji.json changes. The first
+        # element is the version of the format of the cached tables.
+        stat = os.stat(path)
+        cache_key = (2, path, stat.st_mtime, stat.st_size)
+        cached = read_cache("emoji")
+        if cached and cached[0] == cache_key:
+            return cached[1], cached[2]
+
         with open(path, "r") as ef:
             emojis = json.loads(ef.read())
             if "emoji" in emojis:
@@ -6119,8 +8293,11 @@ def load_emoji():
                 emoji_with_skin_tones = chain(
                     emoji_unicode.items(), emoji_skin_tones.items()
                 )
-                emoji_with_skin_tones_reverse = {v: k for k, v in emoji_with_skin_tones}
-                return emoji_unicode, emoji_with_skin_tones_reverse
+                emoji_chars_trie = build_emoji_trie(
+                    (v, k) for k, v in emoji_with_skin_tones
+                )
+                write_cache("emoji", (cache_key, emoji_unicode, emoji_chars_trie))
+                return emoji_unicode, emoji_chars_trie
     except:
         dbg("Couldn't load emoji list: {}".format(format_exc_only()), 5)
     return {}, {}
@@ -6344,6 +8521,13 @@ class PluginConfig(object):
             " debug_mode is on. Lower levels -> more messages.",
         ),
         "distracting_channels": Setting(default="", desc="List of channels to hide."),
+        "event_drain_budget": Setting(
+            default="5",
+            desc="How long (ms) to spend processing queued events on each tick of"
+            " the event loop. Larger values let wee-slack catch up faster after a"
+            " reconnect, at the cost of longer pauses in the UI. Set to 0 to"
+            " process only one event per tick.",
+        ),
         "external_user_suffix": Setting(
             default="*", desc="The suffix appended to nicks to indicate external users."
         ),
@@ -6362,6 +8546,19 @@ class PluginConfig(object):
             desc="The number of messages to fetch for each channel when fetching"
             " history, between 1 and 1000.",
         ),
+        "http_connection_pool": Setting(
+            default="false",
+            desc="Send Slack API requests over a pool of persistent HTTPS"
+            " connections in background threads, instead of starting a new"
+            " process with a new TLS handshake for each request. This makes"
+            " connecting to large teams a lot faster.",
+        ),
+        "http_connection_pool_size": Setting(
+            default="4",
+            desc="The number of connections in the pool used when"
+            " http_connection_pool is enabled. Changes take effect after"
+            " reloading the script.",
+        ),
         "link_previews": Setting(
             default="true", desc="Show previews of website content linked by teammates."
         ),
@@ -6371,6 +8568,23 @@ class PluginConfig(object):
             ' character for it. The default ("_") sends it as italics. Use'
             ' "*" to send bold instead.',
         ),
+        "message_json_budget": Setting(
+            default="0",
+            desc="The number of the newest messages in each channel which keep"
+            " the full message data from Slack. Older messages only keep their"
+            " rendered text and what's needed to update them, which saves a lot"
+            " of memory with background_load_all_history. The text of older"
+            " messages is only rendered again when they change, or when"
+            " /rehistory fetches their data from Slack again, so changed"
+            " settings only affect them after /rehistory. Set to 0 to keep the"
+            " data for all messages.",
+        ),
+        "message_update_interval": Setting(
+            default="200",
+            desc="The minimum time (ms) between updates of messages which are"
+            " edited or get reactions or thread replies. Changes in between are"
+            " shown together, so a burst of them only renders the messages once.",
+        ),
         "muted_channels_activity": Setting(
             default="personal_highlights",
             desc="Control which activity you see from muted channels, either"
@@ -6527,6 +8741,10 @@ class PluginConfig(object):
         else:
             key = full_key.replace(CONFIG_PREFIX + ".", "")
             self.settings[key] = self.fetch_setting(key)
+        # The external user suffix and the channel prefixes are part of the
+        # resolved references
+        invalidate_resolved_refs()
+        WEECHAT_COLORS.clear()
 
         if (
             full_key is None or full_key == CONFIG_PREFIX + ".debug_mode"
@@ -6573,11 +8791,15 @@ class PluginConfig(object):
     get_color_typing_notice = get_string
     get_colorize_attachments = get_string
     get_debug_level = get_int
+    get_event_drain_budget = get_int
     get_external_user_suffix = get_string
     get_files_download_location = get_string
     get_group_name_prefix = get_string
     get_history_fetch_count = get_int
+    get_http_connection_pool_size = get_int
     get_map_underline_to = get_string
+    get_message_json_budget = get_int
+    get_message_update_interval = get_int
     get_muted_channels_activity = get_string
     get_thread_broadcast_prefix = get_string
     get_render_bold_as = get_string
@@ -6631,6 +8853,12 @@ class PluginConfig(object):
             w.config_set_plugin("color_thread_suffix", old_thread_color_config)
 
 
+def config_palette_cb(data, key, value):
+    # Color aliases are resolved when the color code is looked up
+    WEECHAT_COLORS.clear()
+    return w.WEECHAT_RC_OK
+
+
 def config_server_buffer_cb(data, key, value):
     for team in EVENTROUTER.teams.values():
         team.buffer_merge(value)
@@ -6720,6 +8948,7 @@ if __name__ == "__main__":
 
             receive_httprequest_callback = EVENTROUTER.receive_httprequest_callback
             receive_ws_callback = EVENTROUTER.receive_ws_callback
+            receive_worker_callback = EVENTROUTER.receive_worker_callback
 
             # Global var section
             slack_debug = None
@@ -6732,10 +8961,10 @@ if __name__ == "__main__":
 
             w.hook_config(CONFIG_PREFIX + ".*", "config_changed_cb", "")
             w.hook_config("irc.look.server_buffer", "config_server_buffer_cb", "")
+            w.hook_config("weechat.palette.*", "config_palette_cb", "")
             if weechat_version < 0x2090000:
                 w.hook_modifier("input_text_for_buffer", "input_text_for_buffer_cb", "")
 
-            EMOJI, EMOJI_WITH_SKIN_TONES_REVERSE = load_emoji()
             setup_hooks()
 
             if config.record_events:
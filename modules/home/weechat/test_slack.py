@@ -0,0 +1,678 @@
+import importlib.util
+import itertools
+import json
+import pathlib
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("websocket")
+
+SLACK_PY = pathlib.Path(__file__).parent / ".weechat" / "python" / "slack.py"
+
+
+class FakeWeechat(types.ModuleType):
+  """
+  The parts of the weechat module the tests need. The rest are no-ops which
+  are recorded in calls.
+  """
+
+  WEECHAT_RC_OK = 0
+  WEECHAT_RC_ERROR = -1
+
+  def __init__(self):
+    super().__init__("weechat")
+    self.plugin_config = {}
+    self.processes = []
+    self.calls = []
+    self.pointers = itertools.count(1)
+
+  def __getattribute__(self, name):
+    # WeechatWrapper looks up attributes with __getattribute__
+    try:
+      return super().__getattribute__(name)
+    except AttributeError:
+      return lambda *args: self.calls.append((name,) + args) or ""
+
+  def called(self, name):
+    return [call[1:] for call in self.calls if call[0] == name]
+
+  def pointer(self):
+    return "0x{:x}".format(next(self.pointers))
+
+  def buffer_new(self, *args):
+    return self.pointer()
+
+  def hook_timer(self, *args):
+    return self.pointer()
+
+  def nicklist_search_nick(self, buffer, group, name):
+    return "nick:" + name
+
+  def info_get(self, name, args=""):
+    return str(0x3000000) if name == "version_number" else ""
+
+  def config_get_plugin(self, name):
+    return self.plugin_config.get(name, "")
+
+  def config_set_plugin(self, name, value):
+    self.plugin_config[name] = value
+
+  def config_is_set_plugin(self, name):
+    return name in self.plugin_config
+
+  def config_integer(self, option):
+    return 4096
+
+  def config_string_to_boolean(self, value):
+    return 1 if value in ("true", "on", "1") else 0
+
+  def hook_process_hashtable(self, command, options, timeout, callback, data):
+    if callback:
+      self.processes.append(data)
+    return "0x1"
+
+
+@pytest.fixture
+def slack(monkeypatch):
+  weechat = FakeWeechat()
+  monkeypatch.setitem(sys.modules, "weechat", weechat)
+  spec = importlib.util.spec_from_file_location("slack", SLACK_PY)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  module.w = module.WeechatWrapper(weechat)
+  module.weechat_version = 0x3000000
+  module.slack_debug = None
+  module.config = module.PluginConfig()
+  module.EVENTROUTER = module.EventRouter()
+  module.hdata = module.Hdata(module.w)
+  return module
+
+
+def user_json(user_id, name, team_id="T1"):
+  profile = {"display_name": name, "real_name": name.title()}
+  return {"id": user_id, "name": name, "team_id": team_id, "profile": profile}
+
+
+def channel_json(channel_id, name, members=("U1",), **kwargs):
+  channel = {
+    "id": channel_id,
+    "name": name,
+    "is_shared": False,
+    "is_mpim": False,
+    "is_private": False,
+    "is_member": False,
+    "is_archived": False,
+    "members": list(members),
+  }
+  channel.update(kwargs)
+  return channel
+
+
+@pytest.fixture
+def make_team(slack):
+  def make_team(users=(), channels=(), ims=()):
+    request = slack.SlackRequest(
+      None, "rtm.start", {}, token="xoxp-1", metadata={"reconnect": False}
+    )
+    login = {
+      "ok": True,
+      "wee_slack_request_metadata": request,
+      "url": "wss://example.com",
+      "self": {
+        "id": "U1",
+        "name": "me",
+        "manual_presence": "active",
+        "prefs": {"muted_channels": "", "highlight_words": ""},
+      },
+      "team": {"id": "T1", "domain": "example", "name": "Example"},
+      "users": [user_json("U1", "me")] + list(users),
+      "bots": [],
+      "subteams": {"all": [], "self": []},
+      "channels": list(channels),
+      "ims": list(ims),
+      "mpims": [],
+      "groups": [],
+    }
+    slack.handle_rtmstart(login, slack.EVENTROUTER, None, None, {})
+    # Drop the requests made when connecting, like for channel history
+    slack.EVENTROUTER.request_scheduler = slack.SlackRequestScheduler()
+    return next(iter(slack.EVENTROUTER.teams.values()))
+
+  return make_team
+
+
+def conversations_info(slack):
+  return slack.SlackRequest(
+    None, "conversations.info", {"channel": "C1"}, token="xoxp-1", retries=1
+  )
+
+
+def send(slack, router):
+  for request in router.request_scheduler.ready_requests():
+    router.handle_event(request)
+  return router.retrieve_context(slack.w.processes.pop())
+
+
+def test_failed_request_does_not_block_identical_request(slack):
+  router = slack.EVENTROUTER
+  router.receive(conversations_info(slack))
+  request = send(slack, router)
+  router.receive_httprequest_callback(
+    router.store_context(request), "", 6, "", "Could not resolve host"
+  )
+  assert not router.inflight_requests
+
+  retry = conversations_info(slack)
+  router.receive(retry)
+  assert send(slack, router) is retry
+
+
+def test_undecodable_reply_is_retried_then_released(slack):
+  router = slack.EVENTROUTER
+  router.receive(conversations_info(slack))
+  request = send(slack, router)
+  request.retries = 2
+  reply = "HTTP/1.1 200 OK\r\n\r\n{\"ok\": tr"
+  router.receive_httprequest_callback(router.store_context(request), "", 0, reply, "")
+  assert not router.reply_buffer
+  assert len(router.request_scheduler) == 1
+
+  request.tries = 2
+  router.receive_httprequest_callback(router.store_context(request), "", 0, reply, "")
+  assert not router.reply_buffer
+  assert not router.inflight_requests
+
+
+def api_request(slack, method, slow=False, **post_data):
+  request = slack.SlackRequest(None, method, post_data, token="xoxp-1")
+  if slow:
+    request.priority = slack.REQUEST_PRIORITY_BACKGROUND
+  return request
+
+
+def test_scheduler_sends_interactive_requests_first(slack):
+  scheduler = slack.SlackRequestScheduler()
+  background = [api_request(slack, "users.info", True, user=i) for i in range(3)]
+  interactive = [api_request(slack, "users.info", user=i) for i in range(3, 5)]
+  for request in background + interactive:
+    scheduler.add(request)
+
+  assert scheduler.ready_requests() == interactive + background
+  assert len(scheduler) == 0
+
+
+def test_scheduler_respects_the_method_burst(slack):
+  scheduler = slack.SlackRequestScheduler()
+  requests = [api_request(slack, "rtm.connect", n=i) for i in range(5)]
+  for request in requests:
+    scheduler.add(request)
+
+  # Tier 1 allows a burst of 3
+  assert scheduler.ready_requests() == requests[:3]
+  assert scheduler.ready_requests() == []
+  assert len(scheduler) == 2
+
+
+def test_scheduler_keeps_a_token_for_interactive_requests(slack):
+  scheduler = slack.SlackRequestScheduler()
+  background = [api_request(slack, "users.list", True, n=i) for i in range(5)]
+  for request in background:
+    scheduler.add(request)
+  assert scheduler.ready_requests() == background[:4]
+
+  interactive = api_request(slack, "users.list", n=5)
+  scheduler.add(interactive)
+  assert scheduler.ready_requests() == [interactive]
+
+
+def test_rate_limited_request_is_retried_first(slack):
+  router = slack.EVENTROUTER
+  scheduler = router.request_scheduler
+  router.receive(conversations_info(slack))
+  request = send(slack, router)
+  waiting = api_request(slack, "conversations.info", channel="C2")
+  router.receive(waiting)
+
+  reply = "HTTP/1.1 429 Too Many Requests\r\nRetry-After: 30\r\n\r\n"
+  router.receive_httprequest_callback(router.store_context(request), "", 0, reply, "")
+  assert request.tries == 0
+  assert [method for method, _ in scheduler.blocked_methods()] == [
+    "conversations.info"
+  ]
+  assert scheduler.ready_requests() == []
+
+  bucket = scheduler.get_bucket(request.rate_limit_key())
+  bucket.blocked_until = bucket.last_refill = 0
+  assert scheduler.ready_requests() == [request, waiting]
+
+
+def sent_requests(slack):
+  requests = []
+  router = slack.EVENTROUTER
+  while True:
+    ready = router.request_scheduler.ready_requests()
+    if not ready:
+      return requests
+    for request in ready:
+      router.handle_event(request)
+      requests.append(router.retrieve_context(slack.w.processes.pop()))
+
+
+def reply(slack, request, body):
+  router = slack.EVENTROUTER
+  response = "HTTP/1.1 200 OK\r\n\r\n" + json.dumps(body)
+  context = router.store_context(request)
+  router.receive_httprequest_callback(context, "", 0, response, "")
+  while router.queue:
+    router.handle_event(router.queue.popleft())
+
+
+def test_user_resolver_updates_each_channel_once(slack, make_team, monkeypatch):
+  team = make_team(
+    channels=[
+      channel_json("C1", "one", is_member=True),
+      channel_json("C2", "two", is_member=True),
+    ]
+  )
+  one, two = team.channels["C1"], team.channels["C2"]
+  updated = []
+  for channel in (one, two):
+    monkeypatch.setattr(
+      channel, "update_nicklist", lambda user=None, c=channel: updated.append(c.name)
+    )
+
+  team.user_resolver.resolve(["U1", "U2", "U3"], one)
+  team.user_resolver.flush()
+  # Only users which are being resolved already
+  team.user_resolver.resolve(["U2", "U3"], two)
+  requests = sent_requests(slack)
+  assert sorted(request.post_data["user"] for request in requests) == ["U2", "U3"]
+
+  for request in requests:
+    user_id = request.post_data["user"]
+    reply(slack, request, {"ok": True, "user": user_json(user_id, user_id.lower())})
+  assert sorted(updated) == ["#one", "#two"]
+  assert team.user_resolver.outstanding == 0
+  assert "U2" in team.users and "U3" in team.users
+
+
+def test_user_resolver_caps_external_lookups(slack, make_team, monkeypatch):
+  monkeypatch.setattr(slack, "USER_RESOLVE_INFO_LIMIT", 5)
+  team = make_team(
+    channels=[channel_json("C1", "shared", is_shared=True, is_member=True)]
+  )
+  shared = team.channels["C1"]
+  external = ["E{}".format(i) for i in range(50)]
+  team.user_resolver.resolve(external, shared)
+  team.user_resolver.flush()
+
+  requests = sent_requests(slack)
+  assert [request.request for request in requests] == ["users.info"] * 5
+  assert team.user_resolver.outstanding == 5
+
+
+def test_channel_messages_stay_sorted(slack):
+  messages = slack.SlackChannelMessages()
+  timestamps = [slack.SlackTS("1600000000.{:06d}".format(i)) for i in range(10)]
+  for ts in timestamps[5:] + timestamps[:5][::-1]:
+    messages[ts] = str(ts)
+  messages[timestamps[7]] = "replaced"
+
+  assert list(messages) == timestamps
+  assert list(reversed(messages)) == timestamps[::-1]
+  assert messages.key_at(0) == timestamps[0]
+  assert messages.key_at(-1) == timestamps[-1]
+  assert messages[timestamps[7]] == "replaced"
+
+  del messages[timestamps[0]]
+  del messages[timestamps[4]]
+  assert list(messages) == timestamps[1:4] + timestamps[5:]
+  assert len(messages) == 8
+  assert timestamps[4] not in messages
+
+
+def assert_hashes_are_unique(hashes):
+  short_hashes = sorted(key for key in hashes if isinstance(key, str))
+  for short_hash, next_hash in zip(short_hashes, short_hashes[1:]):
+    assert not next_hash.startswith(short_hash)
+  for short_hash in short_hashes:
+    assert len(short_hash) >= 3
+    assert hashes[hashes[short_hash]] == short_hash
+
+
+def test_message_hashes_are_unique_prefixes(slack):
+  channel = types.SimpleNamespace(messages={})
+  hashes = slack.SlackChannelHashedMessages(channel)
+  timestamps = [slack.SlackTS("1600000000.{:06d}".format(i)) for i in range(2000)]
+  for ts in timestamps:
+    hashes[ts]
+  assert_hashes_are_unique(hashes)
+
+  removed, kept = timestamps[::2], timestamps[1::2]
+  for ts in removed:
+    del hashes[hashes.pop(ts)]
+  assert_hashes_are_unique(hashes)
+  for ts in kept:
+    assert hashes[hashes[ts]] == ts
+  assert len(hashes) == 2 * len(kept)
+
+  for ts in removed:
+    hashes[ts]
+  assert_hashes_are_unique(hashes)
+  assert len(hashes) == 2 * len(timestamps)
+
+
+def test_slack_ts_compares_hashes_and_formats(slack):
+  ts = slack.SlackTS("1600000000.000042")
+  assert str(ts) == "1600000000.000042"
+  assert slack.SlackTS(str(ts)) == ts
+  assert slack.SlackTS(ts) == ts
+  assert (ts.major, ts.minor) == (1600000000, 42)
+  assert slack.SlackTS(1600000000) == "1600000000.000000"
+
+  later = slack.SlackTS("1600000000.000100")
+  assert ts < later and ts <= later and later > ts and later >= ts
+  assert ts != later
+  assert ts < "1600000000.000100" and ts > "1599999999.999999"
+  assert ts == "1600000000.000042" and ts != "1600000000.000043"
+
+  assert hash(slack.SlackTS("1600000000.000042")) == hash(ts)
+  assert {ts: "message"}[slack.SlackTS("1600000000.000042")] == "message"
+  assert sorted([later, ts]) == [ts, later]
+
+
+def message_json(ts, text, **kwargs):
+  message = {"ts": ts, "user": "U1", "text": text}
+  message.update(kwargs)
+  return message
+
+
+def test_rehistory_refetches_dropped_messages(slack, make_team, monkeypatch):
+  monkeypatch.setitem(slack.config.settings, "message_json_budget", 2)
+  team = make_team(channels=[channel_json("C1", "one", is_member=True)])
+  channel = team.channels["C1"]
+  channel.channel_buffer = slack.w.pointer()
+  timestamps = ["1600000000.00000{}".format(i) for i in range(1, 5)]
+  for ts in timestamps:
+    channel.store_message(
+      slack.SlackMessage("normal", message_json(ts, "old " + ts), channel)
+    )
+  dropped = [channel.messages[slack.SlackTS(ts)] for ts in timestamps[:2]]
+  assert [m.rendered_body is not None for m in dropped] == [True, True]
+
+  channel.reprint_messages(force_render=True)
+  (request,) = sent_requests(slack)
+  assert request.request == "conversations.history"
+  assert request.post_data["oldest"] == timestamps[0]
+  assert request.post_data["latest"] == timestamps[1]
+  assert request.post_data["inclusive"]
+
+  messages = [message_json(ts, "new " + ts) for ts in timestamps[1::-1]]
+  body = {"ok": True, "messages": messages, "response_metadata": {"next_cursor": "c"}}
+  reply(slack, request, body)
+  for m, ts in zip(dropped, timestamps):
+    assert m.render() == "new " + ts
+    assert m.rendered_body is not None
+    assert sorted(m.message_json) == ["text", "ts", "user"]
+  (next_page,) = sent_requests(slack)
+  assert next_page.post_data["cursor"] == "c"
+  assert next_page.post_data["oldest"] == timestamps[0]
+
+
+def test_user_change_replaces_a_hydrated_profile(slack, make_team):
+  team = make_team(users=[user_json("U2", "two"), user_json("U3", "three")])
+  hydrated, slim = team.users["U2"], team.users["U3"]
+  old = user_json("U2", "two")
+  old["profile"].update(title="Old title", status_text="away")
+  hydrated.hydrate(old)
+
+  changes = {}
+  for user in (hydrated, slim):
+    changes[user] = user_json(user.identifier, user.username)
+    changes[user]["profile"].update(real_name="New Name", status_emoji=":tada:")
+    slack.process_user_change(
+      {"user": changes[user]}, slack.EVENTROUTER, team, None, {"user": user}
+    )
+
+  assert hydrated.profile == changes[hydrated]["profile"]
+  assert "title" not in hydrated.profile
+  assert not slim.hydrated
+  for user in (hydrated, slim):
+    assert user.real_name == "New Name"
+    assert (user.status_emoji, user.status_text) == (":tada:", "")
+
+
+def test_name_maps_are_read_only_views(slack, make_team):
+  team = make_team(users=[user_json("U2", "two")])
+  usernames = team.get_username_map()
+  assert usernames["two"] == "U2"
+  with pytest.raises(TypeError):
+    usernames["two"] = "U3"
+
+  team.users["U3"] = slack.SlackUser("T1", **user_json("U3", "three"))
+  assert usernames.get("three") == "U3"
+
+
+def test_materialized_stub_is_unindexed_by_its_indexed_name(slack, make_team):
+  team = make_team(channels=[channel_json("C1", "old")])
+  stub = team.channels.peek("C1")
+  assert isinstance(stub, slack.SlackChannelStub)
+  stub.channel_json["name"] = "new"
+
+  channel = team.channels["C1"]
+  assert team.channels.peek("C1") is channel
+  assert dict(team.get_channel_map()) == {"#new": "C1"}
+
+
+def test_materializing_stubs_keeps_indexes_consistent(slack, make_team):
+  team = make_team(
+    users=[user_json("U2", "two")],
+    channels=[channel_json("C1", "one", members=("U1", "U2"))],
+    ims=[{"id": "D1", "user": "U2", "is_im": True, "is_open": False}],
+  )
+  channels = team.channels
+  stubs = {key: channels.peek(key) for key in ("C1", "D1")}
+  assert all(isinstance(stub, slack.SlackChannelStub) for stub in stubs.values())
+  assert channels.get_by_members({"U2"}) is stubs["D1"]
+
+  dm = channels["D1"]
+  stubs["C1"].set_name("renamed")
+  channel = channels.peek("C1")
+
+  assert not isinstance(channel, slack.SlackChannelStub)
+  assert channels.get_by_members({"U2"}) is dm
+  assert {c.identifier for c in channels.with_member("U2")} == {"C1", "D1"}
+  assert all(c is channels.peek(c.identifier) for c in channels.with_member("U2"))
+  assert dict(team.get_channel_map()) == {"#renamed": "C1", "two": "D1"}
+  assert len(channels) == 2
+
+
+def test_member_indexes_follow_member_changes(slack, make_team):
+  team = make_team(
+    users=[user_json("U2", "two"), user_json("U3", "three")],
+    channels=[
+      channel_json("C1", "one", members=("U1", "U2")),
+      channel_json("G1", "mpdm-me--two--three-1", ("U1", "U2", "U3"), is_mpim=True),
+    ],
+  )
+  channels = team.channels
+
+  def member_of(user_id):
+    return sorted(c.identifier for c in channels.with_member(user_id))
+
+  assert member_of("U2") == ["C1", "G1"]
+  assert member_of("U3") == ["G1"]
+  assert channels.get_by_members({"U1", "U2", "U3"}) is channels.peek("G1")
+
+  one = channels["C1"]
+  one.user_joined("U3")
+  one.user_left("U2")
+  assert member_of("U2") == ["G1"]
+  assert member_of("U3") == ["C1", "G1"]
+
+  mpim = channels["G1"]
+  mpim.user_left("U3")
+  assert member_of("U3") == ["C1"]
+  assert channels.get_by_members({"U1", "U2", "U3"}) is None
+  assert channels.get_by_members({"U1", "U2"}) is mpim
+
+  del channels["C1"]
+  assert member_of("U1") == ["G1"]
+
+
+def test_newer_history_is_appended_without_clearing(slack, make_team):
+  team = make_team(channels=[channel_json("C1", "one", is_member=True)])
+  channel = team.channels["C1"]
+  channel.channel_buffer = slack.w.pointer()
+  metadata = {"slow_queue": False, "no_log": True}
+
+  channel.get_history()
+  assert channel.history_notice_printed
+  history = [message_json("1600000000.00000{}".format(i), "old") for i in (2, 1)]
+  slack.handle_history(
+    {"messages": history}, slack.EVENTROUTER, team, channel, metadata
+  )
+  assert len(slack.w.called("buffer_clear")) == 1
+  assert not channel.history_notice_printed
+
+  channel.get_history()
+  assert not channel.history_notice_printed
+  del slack.w.calls[:]
+  history = [message_json("1600000000.000003", "new")]
+  slack.handle_history(
+    {"messages": history}, slack.EVENTROUTER, team, channel, metadata
+  )
+  assert slack.w.called("buffer_clear") == []
+  assert [call[3] for call in slack.w.called("prnt_date_tags")] == ["me\tnew"]
+
+
+def test_changed_messages_are_coalesced(slack, make_team, monkeypatch):
+  team = make_team(channels=[channel_json("C1", "one", is_member=True)])
+  channel = team.channels["C1"]
+  controller = slack.EVENTROUTER.weechat_controller
+  updated = []
+  monkeypatch.setattr(channel, "update_message_lines", lambda m: updated.append(m.ts))
+  for ts in ("1600000000.000001", "1600000000.000002"):
+    channel.store_message(slack.SlackMessage("normal", message_json(ts, ts), channel))
+  first, second = channel.messages
+
+  # The first change after an idle interval is shown right away
+  channel.change_message(first)
+  controller.update_changed_messages()
+  assert updated == [first]
+
+  # A change within the interval waits for it, even if it's the only one
+  channel.change_message(second)
+  controller.update_changed_messages()
+  channel.change_message(first)
+  controller.update_changed_messages()
+  assert updated == [first]
+
+  controller.next_update_time = 0
+  controller.update_changed_messages()
+  assert updated == [first, first, second]
+
+
+def test_nicklist_sync_only_changes_what_differs(slack, make_team):
+  users = [user_json("U2", "two"), user_json("U3", "three"), user_json("U4", "four")]
+  team = make_team(
+    users=users,
+    channels=[channel_json("C1", "one", ("U1", "U2", "U3"), is_member=True)],
+  )
+  channel = team.channels["C1"]
+  channel.channel_buffer = slack.w.pointer()
+
+  def nicklist_calls():
+    added = sorted(call[2] for call in slack.w.called("nicklist_add_nick"))
+    removed = sorted(call[1] for call in slack.w.called("nicklist_remove_nick"))
+    del slack.w.calls[:]
+    return added, removed
+
+  channel.update_nicklist()
+  assert len(slack.w.called("nicklist_remove_all")) == 1
+  assert nicklist_calls() == (["me", "three", "two"], [])
+
+  channel.update_nicklist()
+  assert nicklist_calls() == ([], [])
+
+  channel.user_left("U3")
+  channel.user_joined("U4")
+  assert nicklist_calls() == (["four"], ["nick:three"])
+
+  channel.update_nicklist()
+  assert slack.w.called("nicklist_remove_all") == []
+  assert nicklist_calls() == ([], [])
+
+
+
+# Messages as they come from Slack, and what they rendered to before the
+# renderer was optimized, with colors shown as [name]
+RECORDED_MESSAGES = [
+  {"text": "*bold* and _italic_ for <@U2> in <#C1|one>, not a*b*c or snake_case_name"},
+  {
+    "text": "see <https://example.com|example>, <https://example.com/a|example.com/a>"
+    " and <mailto:me@example.com|me@example.com> :smile: &lt;tag&gt; &amp; :nope:"
+  },
+  {
+    "text": "<!here> <!subteam^S1|@devs> <!date^1600000000^{date}|Sep 13th>"
+    " <@U9|ghost>"
+  },
+  {"text": "edited *twice*", "edited": {"user": "U2", "ts": "1600000000.000100"}},
+  {
+    "text": "with attachment",
+    "attachments": [
+      {
+        "fallback": "fallback",
+        "title": "Title",
+        "title_link": "https://example.com/t",
+        "text": "*attached* <@U2>",
+        "footer": "footer",
+      }
+    ],
+  },
+  {
+    "text": "reacted",
+    "reactions": [{"name": "smile", "users": ["U1", "U2"], "count": 2}],
+  },
+  {"subtype": "me_message", "text": "waves _slowly_"},
+  {"subtype": "channel_join", "text": "<@U2> has joined the channel", "inviter": "U1"},
+  {
+    "text": "fallback",
+    "blocks": [
+      {"type": "section", "text": {"type": "mrkdwn", "text": "*section* <@U2>"}}
+    ],
+  },
+]
+
+RENDERED_MESSAGES = [
+  "[bold]*bold*[-bold] and [italic]_italic_[-italic] for @two in #one,"
+  " not a*b*c or snake_case_name",
+  "see https://example.com (example), https://example.com/a (example.com/a)"
+  " and mailto:me@example.com (me@example.com) \U0001f604 <tag> & :nope:",
+  "@here @devs September 13, 2020 ghost",
+  "edited [bold]*twice*[-bold] [095](edited)[reset]",
+  "with attachment\n| Title (https://example.com/t)\n| *attached* @two\n| footer",
+  "reacted [darkgray][[blue]\U0001f6042[darkgray]][reset]",
+  "me waves [italic]_slowly_[-italic]",
+  "@two has joined the channel by invitation from @me",
+  "[bold]*section*[-bold] @two",
+]
+
+
+def test_recorded_messages_render_as_before(slack, make_team, monkeypatch):
+  monkeypatch.setattr(slack.w.wrapped_class, "color", lambda name: "[{}]".format(name))
+  monkeypatch.setattr(slack, "EMOJI", {"smile": "\U0001f604"})
+  monkeypatch.setattr(slack, "EMOJI_LOADED", True)
+  team = make_team(
+    users=[user_json("U2", "two")],
+    channels=[channel_json("C1", "one", is_member=True)],
+  )
+  channel = team.channels["C1"]
+  rendered = []
+  for i, recorded in enumerate(RECORDED_MESSAGES):
+    recorded = dict(recorded, ts="1600000000.00000{}".format(i), user="U1")
+    subtype = recorded.get("subtype", "normal")
+    rendered.append(slack.SlackMessage(subtype, recorded, channel).render())
+  assert rendered == RENDERED_MESSAGES